@@ -1,28 +1,62 @@
 """
-Server-side caching utilities for API responses.
+Server-side caching utilities for API responses and query embeddings.
 """
-import hashlib
-import json
+import asyncio
 import logging
 from functools import wraps
-from typing import Any, Callable, Optional, TypeVar
+from typing import Any, Awaitable, Callable, Dict, List, Optional, TypeVar
 
-from cachetools import TTLCache
+import msgspec
+import xxhash
+from cachetools import LRUCache, TTLCache
+
+from api.config import settings
+from api.models import BookRecord
 
 logger = logging.getLogger(__name__)
 
 # Global cache instance
 # TTL cache: max 1000 entries, 10 minute TTL
-_recommendation_cache: TTLCache[str, Any] = TTLCache(maxsize=1000, ttl=600)  # 10 minutes
+_recommendation_cache: TTLCache[int, Any] = TTLCache(maxsize=1000, ttl=600)  # 10 minutes
 _book_cache: TTLCache[str, Any] = TTLCache(maxsize=5000, ttl=3600)  # 1 hour for book details
+# Negative tier: queries that matched nothing are retried sooner, so newly
+# ingested books show up without waiting out the full recommendation TTL
+_empty_recommendation_cache: TTLCache[int, Any] = TTLCache(maxsize=1000, ttl=300)  # 5 minutes
+# Query embeddings keyed by normalized query text. They depend only on the
+# model, not on the books table, so they never expire (~1.5KB each)
+_embedding_cache: LRUCache[str, Any] = LRUCache(maxsize=4096)
+# Embedding cache lookups since startup, reported by get_cache_stats()
+_embedding_stats: Dict[str, int] = {"hits": 0, "misses": 0}
+
+# In-flight recommendation computations, keyed like _recommendation_cache.
+# Concurrent misses for the same query share one computation instead of
+# each encoding the query and hitting the database.
+_inflight_recommendations: Dict[int, "asyncio.Task[Any]"] = {}
+
+# Optional Redis tier shared by all workers (settings.redis_url); the
+# in-process caches above stay in front of it as a per-worker L1
+_redis: Optional[Any] = None
+SHARED_RECOMMENDATION_PREFIX = "rec:"
+# Held briefly by the worker clearing the shared tier for a burst of book
+# changes, so the other workers skip their identical clear
+SHARED_CLEAR_LOCK_KEY = "lock:rec-clear"
+_recommendation_encoder = msgspec.msgpack.Encoder()
+_recommendation_decoder = msgspec.msgpack.Decoder(List[BookRecord])
 
 F = TypeVar('F', bound=Callable[..., Any])
 
 
-def cache_key_for_recommendation(query: str, limit: int) -> str:
-    """Generate a cache key for recommendation requests."""
-    key_data = json.dumps({"query": query, "limit": limit}, sort_keys=True)
-    return hashlib.md5(key_data.encode()).hexdigest()
+def cache_key_for_recommendation(query: str, limit: int) -> int:
+    """
+    Generate a cache key for recommendation requests.
+    
+    The query is normalized like embedding keys (queries sharing an
+    embedding share results) and hashed with xxh3 together with the
+    limit. Callers compute the key once per request and pass it to the
+    lookup, coalescing and store calls; int keys are the cheapest dict
+    keys to hash and compare.
+    """
+    return xxhash.xxh3_64_intdigest(f"{cache_key_for_embedding(query)}|{limit}".encode())
 
 
 def cache_key_for_book(book_id: int) -> str:
@@ -30,17 +64,202 @@ def cache_key_for_book(book_id: int) -> str:
     return f"book:{book_id}"
 
 
-def get_cached_recommendation(query: str, limit: int) -> Optional[Any]:
+def get_cached_recommendation(key: int) -> Optional[Any]:
     """Get cached recommendation if available."""
-    key = cache_key_for_recommendation(query, limit)
-    return _recommendation_cache.get(key)
+    cached = _recommendation_cache.get(key)
+    if cached is None:
+        cached = _empty_recommendation_cache.get(key)
+    return cached
 
 
-def set_cached_recommendation(query: str, limit: int, data: Any) -> None:
+def set_cached_recommendation(key: int, data: Any) -> None:
     """Cache a recommendation response."""
-    key = cache_key_for_recommendation(query, limit)
-    _recommendation_cache[key] = data
-    logger.debug(f"Cached recommendation for query: {query[:50]}...")
+    if data:
+        _recommendation_cache[key] = data
+    else:
+        _empty_recommendation_cache[key] = data
+    logger.debug(f"Cached recommendation for key: {key:016x}")
+
+
+def _forget_inflight(key: int, task: "asyncio.Task[Any]") -> None:
+    """Done callback: drop a finished computation from the in-flight map."""
+    if _inflight_recommendations.get(key) is task:
+        del _inflight_recommendations[key]
+    # Mark any exception as retrieved so asyncio doesn't warn when every
+    # waiter went away before the computation failed
+    if not task.cancelled():
+        task.exception()
+
+
+async def coalesce_recommendation(
+    key: int,
+    compute: Callable[[], Awaitable[Any]]
+) -> Any:
+    """
+    Run compute() once per recommendation cache key across concurrent callers.
+    
+    The first caller starts compute() as a detached task; it and every
+    caller arriving while it runs await the same result (or exception).
+    Each caller waits through asyncio.shield, so a disconnected or
+    cancelled request only abandons its own wait and never cancels the
+    computation the others depend on.
+    
+    Args:
+        key: Key from cache_key_for_recommendation()
+        compute: Coroutine factory producing the recommendation response
+    
+    Returns:
+        Result of compute()
+    """
+    task = _inflight_recommendations.get(key)
+    if task is None:
+        task = asyncio.create_task(compute())
+        _inflight_recommendations[key] = task
+        task.add_done_callback(lambda done: _forget_inflight(key, done))
+    else:
+        logger.debug(f"Joining in-flight recommendation for key: {key:016x}")
+    
+    return await asyncio.shield(task)
+
+
+async def init_shared_cache() -> None:
+    """
+    Connect the shared Redis recommendation cache if REDIS_URL is set.
+    
+    An unreachable Redis doesn't block startup: lookups are treated as
+    misses until it becomes available.
+    """
+    global _redis
+    
+    if not settings.redis_url or _redis is not None:
+        return
+    
+    # Imported lazily so per-process deployments don't need redis installed
+    from redis.asyncio import Redis
+    
+    _redis = Redis.from_url(
+        settings.redis_url,
+        socket_timeout=settings.redis_timeout,
+        socket_connect_timeout=settings.redis_timeout
+    )
+    try:
+        await _redis.ping()
+        logger.info("✅ Shared recommendation cache connected")
+    except Exception as e:
+        logger.warning(f"Shared recommendation cache unavailable, using local caches: {e}")
+
+
+async def close_shared_cache() -> None:
+    """Close the shared Redis connection, if any."""
+    global _redis
+    
+    if _redis is not None:
+        client, _redis = _redis, None
+        try:
+            await client.aclose()
+        except Exception as e:
+            logger.warning(f"Error closing shared cache connection: {e}")
+
+
+def _shared_key(key: int) -> str:
+    """Redis key for a recommendation cache key."""
+    return f"{SHARED_RECOMMENDATION_PREFIX}{key:016x}"
+
+
+async def get_shared_recommendation(key: int) -> Optional[List[BookRecord]]:
+    """
+    Get a recommendation from the shared cache if available.
+    
+    A hit is also stored in the local cache. Redis errors and payloads
+    that no longer decode count as misses.
+    """
+    if _redis is None:
+        return None
+    
+    try:
+        payload = await _redis.get(_shared_key(key))
+    except Exception as e:
+        logger.warning(f"Shared cache lookup failed: {e}")
+        return None
+    if payload is None:
+        return None
+    
+    try:
+        books = _recommendation_decoder.decode(payload)
+    except (msgspec.DecodeError, msgspec.ValidationError) as e:
+        # Stale or foreign payload (e.g. written before a BookRecord change):
+        # drop it and let the caller recompute
+        logger.debug(f"Discarding undecodable shared recommendation {_shared_key(key)}: {e}")
+        try:
+            await _redis.unlink(_shared_key(key))
+        except Exception as e:
+            logger.warning(f"Shared cache cleanup failed: {e}")
+        return None
+    
+    set_cached_recommendation(key, books)
+    return books
+
+
+async def set_shared_recommendation(key: int, books: List[BookRecord]) -> None:
+    """Store a recommendation in the shared cache, with the local tier's TTL."""
+    if _redis is None:
+        return
+    
+    cache = _recommendation_cache if books else _empty_recommendation_cache
+    try:
+        await _redis.set(_shared_key(key), _recommendation_encoder.encode(books), ex=int(cache.ttl))
+    except Exception as e:
+        logger.warning(f"Shared cache store failed: {e}")
+
+
+async def clear_shared_recommendations(dedupe_window: float = 0.0) -> None:
+    """
+    Drop every recommendation from the shared cache.
+    
+    Called alongside local invalidation, since a books table change can
+    alter any cached result.
+    
+    Args:
+        dedupe_window: If set, only the first worker to call within this
+            many seconds runs the clear. Every worker receives the same
+            book change notifications, so one SCAN per burst is enough.
+    """
+    if _redis is None:
+        return
+    
+    try:
+        if dedupe_window > 0 and not await _redis.set(
+            SHARED_CLEAR_LOCK_KEY, 1, nx=True, px=int(dedupe_window * 1000)
+        ):
+            return
+        keys = [key async for key in _redis.scan_iter(match=f"{SHARED_RECOMMENDATION_PREFIX}*", count=1000)]
+        if keys:
+            await _redis.unlink(*keys)
+    except Exception as e:
+        logger.warning(f"Shared cache clear failed: {e}")
+
+
+def cache_key_for_embedding(query: str) -> str:
+    """
+    Generate a cache key for a query embedding.
+    
+    Collapses whitespace and case so trivially different spellings of a
+    query share one embedding (the default MiniLM model is uncased).
+    """
+    return " ".join(query.split()).casefold()
+
+
+def get_cached_embedding(query: str) -> Optional[Any]:
+    """Get a cached query embedding if available."""
+    embedding = _embedding_cache.get(cache_key_for_embedding(query))
+    _embedding_stats["hits" if embedding is not None else "misses"] += 1
+    return embedding
+
+
+def set_cached_embedding(query: str, embedding: Any) -> None:
+    """Cache a query embedding. The array is made read-only since it is shared."""
+    embedding.setflags(write=False)
+    _embedding_cache[cache_key_for_embedding(query)] = embedding
 
 
 def get_cached_book(book_id: int) -> Optional[Any]:
@@ -56,9 +275,28 @@ def set_cached_book(book_id: int, data: Any) -> None:
     logger.debug(f"Cached book detail for ID: {book_id}")
 
 
+def invalidate_book(book_id: Optional[int] = None) -> None:
+    """
+    Drop cache entries affected by a change to the books table.
+    
+    Any change can alter recommendation results, so those caches are
+    always cleared; the book detail entry is dropped when the changed
+    book's ID is known.
+    
+    Args:
+        book_id: ID of the changed book, or None for bulk inserts
+    """
+    _recommendation_cache.clear()
+    _empty_recommendation_cache.clear()
+    if book_id is not None:
+        _book_cache.pop(cache_key_for_book(book_id), None)
+    logger.debug(f"Invalidated caches for book change (ID: {book_id})")
+
+
 def clear_recommendation_cache() -> None:
     """Clear all recommendation cache entries."""
     _recommendation_cache.clear()
+    _empty_recommendation_cache.clear()
     logger.info("Recommendation cache cleared")
 
 
@@ -68,17 +306,43 @@ def clear_book_cache() -> None:
     logger.info("Book detail cache cleared")
 
 
+def clear_all_caches() -> None:
+    """
+    Clear every cached response in one call.
+    
+    Query embeddings are kept: they don't depend on the books table.
+    """
+    _recommendation_cache.clear()
+    _empty_recommendation_cache.clear()
+    _book_cache.clear()
+    logger.info("All caches cleared")
+
+
+def _cache_info(cache: LRUCache) -> dict:
+    """Size, capacity and TTL (if any) of a single cache."""
+    return {
+        "size": len(cache),
+        "max_size": cache.maxsize,
+        "ttl": getattr(cache, "ttl", None)
+    }
+
+
+def _embedding_cache_info() -> dict:
+    """Embedding cache size plus hit/miss counts, which show how often the model is skipped."""
+    lookups = _embedding_stats["hits"] + _embedding_stats["misses"]
+    return {
+        **_cache_info(_embedding_cache),
+        **_embedding_stats,
+        "hit_rate": _embedding_stats["hits"] / lookups if lookups else 0.0
+    }
+
+
 def get_cache_stats() -> dict:
     """Get cache statistics."""
     return {
-        "recommendations": {
-            "size": len(_recommendation_cache),
-            "max_size": _recommendation_cache.maxsize,
-            "ttl": _recommendation_cache.ttl
-        },
-        "books": {
-            "size": len(_book_cache),
-            "max_size": _book_cache.maxsize,
-            "ttl": _book_cache.ttl
-        }
+        "recommendations": _cache_info(_recommendation_cache),
+        "empty_recommendations": _cache_info(_empty_recommendation_cache),
+        "books": _cache_info(_book_cache),
+        "embeddings": _embedding_cache_info(),
+        "shared_recommendations": {"enabled": _redis is not None}
     }
@@ -4,7 +4,9 @@ Uses pydantic-settings for environment variable management.
 """
 import logging
 import os
+from functools import lru_cache
 from pathlib import Path
+from string import Template
 from typing import Optional
 
 from pydantic import model_validator
@@ -28,9 +30,22 @@ class Settings(BaseSettings):
     postgres_port: int = 5432
     database_pool_min_size: int = 2
     database_pool_max_size: int = 10
+    database_pool_timeout: float = 5.0  # Seconds to wait for a pooled connection
     
     # Model
     embedding_model: str = "all-MiniLM-L6-v2"
+    embedding_backend: str = "torch"  # "torch" (sentence-transformers) or "onnx" (ONNX Runtime, CPU)
+    onnx_cache_dir: str = "models"  # Where exported ONNX models are cached between runs
+    embedding_onnx_quantize: bool = False  # Use a dynamically int8-quantized ONNX model (onnx backend only)
+    embedding_max_seq_length: int = 128  # Queries are short; less padding means fewer FLOPs per encode
+    embedding_num_threads: Optional[int] = None  # Intra-op threads for torch (None = torch default)
+    embedding_batch_max_size: int = 32  # Max queries encoded together by the micro-batcher
+    embedding_batch_max_wait_ms: float = 5.0  # How long the batcher waits for more queries
+    
+    # Shared cache (optional) - recommendations are shared across workers via Redis
+    redis_url: Optional[str] = None  # e.g. redis://localhost:6379/0; unset = per-process caches only
+    redis_timeout: float = 0.25  # Seconds; a slow Redis is treated as a cache miss
+    cache_invalidation_delay: float = 1.0  # Seconds to collect book change notifications into one invalidation
     
     # API
     api_host: str = "0.0.0.0"
@@ -46,6 +61,7 @@ class Settings(BaseSettings):
     # Similarity search
     similarity_threshold: float = 0.4  # Cosine distance threshold (lower = more strict, 0.4 = ~0.6 similarity)
     max_recommendations: int = 100
+    hnsw_ef_search: int = 100  # HNSW candidate list size; a scan returns at most this many rows
     
     model_config = SettingsConfigDict(
         env_file=".env",
@@ -81,12 +97,17 @@ class Settings(BaseSettings):
             self.database_url = f"postgresql://{user}:{password}@{host}:{port}/{db}"
             return self
         
-        # If we still have a DATABASE_URL with ${}, try to expand it
+        # If we still have a DATABASE_URL with ${}, try to expand it.
+        # Only non-empty values are substituted, so a missing component
+        # leaves the placeholder in place instead of producing a malformed URL.
         if self.database_url and "${" in self.database_url:
-            expanded = self.database_url
-            expanded = expanded.replace("${POSTGRES_USER}", user or "")
-            expanded = expanded.replace("${POSTGRES_PASSWORD}", password or "")
-            expanded = expanded.replace("${POSTGRES_DB}", db or "")
+            components = {
+                "POSTGRES_USER": user,
+                "POSTGRES_PASSWORD": password,
+                "POSTGRES_DB": db,
+            }
+            variables = {**os.environ, **{k: v for k, v in components.items() if v}}
+            expanded = Template(self.database_url).safe_substitute(variables)
             if "${" not in expanded:
                 self.database_url = expanded
                 return self
@@ -101,6 +122,17 @@ class Settings(BaseSettings):
 settings = Settings()
 
 
+@lru_cache(maxsize=1)
+def get_settings() -> Settings:
+    """
+    Get the global settings instance.
+    
+    Use this with FastAPI's Depends() instead of Depends(Settings), which
+    would re-read the environment on every request.
+    """
+    return settings
+
+
 def setup_logging(log_level: str = None, log_file: Optional[str] = None) -> None:
     """
     Configure application logging.
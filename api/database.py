@@ -7,88 +7,218 @@ from contextlib import asynccontextmanager
 from typing import AsyncGenerator
 
 import psycopg
-from psycopg_pool import ConnectionPool
+from pgvector.psycopg import register_vector_async
+from psycopg_pool import AsyncConnectionPool, PoolTimeout
 
+from api.cache import clear_all_caches, clear_shared_recommendations, invalidate_book
 from api.config import settings
 
 logger = logging.getLogger(__name__)
 
-# Global connection pool (sync pool, used with asyncio.to_thread)
-_pool: ConnectionPool | None = None
+# Global connection pool (async-native, runs on the event loop)
+_pool: AsyncConnectionPool | None = None
+
+# Channel the books table triggers notify on (see scripts/init_db.sql)
+BOOK_CHANGES_CHANNEL = "book_changes"
+
+# Background task listening for book changes to invalidate caches
+_listener_task: asyncio.Task | None = None
+
+# Book changes received since the last invalidation (None marks inserts),
+# and the task that flushes them after settings.cache_invalidation_delay
+_pending_book_changes: set[int | None] = set()
+_flush_task: asyncio.Task | None = None
+
+# Serializes shutdown so concurrent close calls don't double-close the pool
+_close_lock = asyncio.Lock()
+
+
+async def _configure_connection(conn: psycopg.AsyncConnection) -> None:
+    """
+    Prepare a new pooled connection.
+    
+    Registers the pgvector adapters so numpy embeddings are sent in
+    pgvector's binary format instead of being rendered as text, and sets
+    the HNSW search width for the session so queries don't need an extra
+    SET LOCAL round-trip.
+    """
+    await register_vector_async(conn)
+    await conn.execute(
+        "SELECT set_config('hnsw.ef_search', %s, false)",
+        (str(settings.hnsw_ef_search),)
+    )
+    # The pool expects connections back idle, outside a transaction
+    await conn.commit()
+
+
+def _handle_book_change(payload: str) -> None:
+    """
+    Queue cache invalidation for a book_changes notification payload.
+    
+    The payload is a comma-separated list of changed book IDs, or empty
+    when a statement touched too many rows to list (clear everything).
+    An ETL load sends a notification per batch, so changes are collected
+    and flushed together once settings.cache_invalidation_delay has
+    passed since the first one, instead of clearing caches every time.
+    """
+    global _flush_task
+    
+    try:
+        book_ids = [int(book_id) for book_id in payload.split(",")] if payload else [None]
+    except ValueError:
+        logger.warning(f"Ignoring malformed book change payload: {payload!r}")
+        return
+    
+    _pending_book_changes.update(book_ids)
+    if _flush_task is None:
+        _flush_task = asyncio.create_task(_flush_book_changes())
+
+
+async def _flush_book_changes() -> None:
+    """Invalidate caches once for every book change queued during the delay."""
+    global _flush_task
+    
+    delay = settings.cache_invalidation_delay
+    await asyncio.sleep(delay)
+    
+    # Notifications arriving from here on start the next flush
+    book_ids = list(_pending_book_changes)
+    _pending_book_changes.clear()
+    _flush_task = None
+    
+    if None in book_ids:
+        # A statement too large to list its IDs: any cached book may be stale
+        clear_all_caches()
+    else:
+        for book_id in book_ids:
+            invalidate_book(book_id)
+    # Other workers flush the same burst within a few ms; half the delay
+    # dedupes those without swallowing the next burst's clear
+    await clear_shared_recommendations(dedupe_window=delay / 2)
+
+
+async def _listen_for_book_changes() -> None:
+    """
+    Listen for book change notifications and invalidate cached responses.
+    
+    Runs on a dedicated connection outside the pool. On disconnect it
+    reconnects after a short delay and clears all local caches, since any
+    notifications sent in the meantime were missed. The shared cache is
+    left alone there (every worker start would wipe it); other workers'
+    listeners and its TTL keep it fresh.
+    """
+    while True:
+        try:
+            async with await psycopg.AsyncConnection.connect(
+                settings.database_url, autocommit=True
+            ) as conn:
+                await conn.execute(f"LISTEN {BOOK_CHANGES_CHANNEL}")
+                clear_all_caches()
+                logger.info(f"Listening for book changes on '{BOOK_CHANGES_CHANNEL}'")
+                
+                async for notify in conn.notifies():
+                    _handle_book_change(notify.payload)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.warning(f"Book change listener disconnected: {e}. Reconnecting in 5s")
+            await asyncio.sleep(5)
 
 
 async def init_db_pool() -> None:
     """Initialize the database connection pool."""
-    global _pool
+    global _pool, _listener_task
     
     if _pool is not None:
         logger.warning("Database pool already initialized")
         return
     
     try:
-        _pool = ConnectionPool(
+        pool = AsyncConnectionPool(
             settings.database_url,
             min_size=settings.database_pool_min_size,
             max_size=settings.database_pool_max_size,
-            open=True,
-            timeout=5.0,  # Timeout for getting a connection from pool
+            open=False,
+            timeout=settings.database_pool_timeout,  # Timeout for getting a connection from pool
             max_waiting=10,  # Max number of requests waiting for a connection
             max_idle=300,  # Close idle connections after 5 minutes
+            configure=_configure_connection,
         )
+        await pool.open()
+        _pool = pool
         logger.info(
             f"Database connection pool initialized "
             f"(min={settings.database_pool_min_size}, max={settings.database_pool_max_size})"
         )
+        
+        _listener_task = asyncio.create_task(_listen_for_book_changes())
     except Exception as e:
         logger.error(f"Failed to initialize database pool: {e}")
         raise
 
 
 async def close_db_pool() -> None:
-    """Close the database connection pool."""
-    global _pool
+    """
+    Close the database connection pool.
     
-    if _pool is not None:
-        _pool.close()
-        _pool = None
-        logger.info("Database connection pool closed")
+    Safe to call more than once or concurrently; errors while closing are
+    logged so shutdown can finish.
+    """
+    global _pool, _listener_task, _flush_task
+    
+    async with _close_lock:
+        if _listener_task is not None:
+            _listener_task.cancel()
+            try:
+                await _listener_task
+            except asyncio.CancelledError:
+                pass
+            except Exception as e:
+                logger.warning(f"Book change listener failed during shutdown: {e}")
+            _listener_task = None
+        
+        if _flush_task is not None:
+            _flush_task.cancel()
+            _flush_task = None
+            _pending_book_changes.clear()
+        
+        if _pool is not None:
+            pool, _pool = _pool, None
+            try:
+                await pool.close()
+                logger.info("Database connection pool closed")
+            except Exception as e:
+                logger.error(f"Error closing database pool: {e}")
 
 
 @asynccontextmanager
-async def get_db_connection() -> AsyncGenerator[psycopg.Connection, None]:
+async def get_db_connection() -> AsyncGenerator[psycopg.AsyncConnection, None]:
     """
     Get a database connection from the pool.
-    Uses asyncio.to_thread to run sync database operations in async context.
+    
+    The connection is returned to the pool when the block exits; an open
+    transaction is committed, or rolled back if the block raised.
     
     Usage:
         async with get_db_connection() as conn:
-            with conn.cursor() as cur:
-                cur.execute("SELECT ...")
-                results = cur.fetchall()
+            async with conn.cursor() as cur:
+                await cur.execute("SELECT ...")
+                results = await cur.fetchall()
     """
     if _pool is None:
         raise RuntimeError("Database pool not initialized. Call init_db_pool() first.")
     
-    # Get connection from pool (sync operation in thread)
-    # Use getconn with timeout handling via asyncio.wait_for
+    timeout = settings.database_pool_timeout
     try:
-        conn = await asyncio.wait_for(
-            asyncio.to_thread(_pool.getconn),
-            timeout=10.0
-        )
-    except asyncio.TimeoutError:
+        conn = await _pool.getconn(timeout=timeout)
+    except PoolTimeout as e:
         logger.error("Timeout waiting for database connection from pool")
-        raise RuntimeError("Could not get database connection: timeout after 10 seconds")
-    except Exception as e:
-        logger.error(f"Failed to get database connection from pool: {e}")
-        raise RuntimeError(f"Could not get database connection: {e}") from e
+        raise RuntimeError(f"Could not get database connection: timeout after {timeout} seconds") from e
     
     try:
-        yield conn
+        async with conn:
+            yield conn
     finally:
-        # Return connection to pool
-        try:
-            await asyncio.to_thread(_pool.putconn, conn)
-        except Exception as e:
-            logger.warning(f"Error returning connection to pool: {e}")
-
+        # Shield the return so a request cancelled mid-cleanup can't leak
+        # the connection out of the pool
+        await asyncio.shield(_pool.putconn(conn))
@@ -1,39 +1,207 @@
 """
 Embedding model management and query encoding.
 """
+import asyncio
+import ctypes
+import gc
+import json
 import logging
-from typing import Optional
+import shutil
+import sys
+from pathlib import Path
+from typing import List, Optional, Union
 
+import numpy as np
 from sentence_transformers import SentenceTransformer
 
 from api.config import settings
 
 logger = logging.getLogger(__name__)
 
+# Query lengths (in words) encoded at startup so the first real requests
+# don't pay for kernel selection on an unseen input shape
+_WARMUP_LENGTHS = (8, 32, 128)
+
+# sentence-transformers' per-model settings file, which holds max_seq_length
+SENTENCE_BERT_CONFIG = "sentence_bert_config.json"
+
+
+def _sentence_transformer_max_seq_length(model_id: str, export_dir: Path) -> Optional[int]:
+    """
+    Read the max_seq_length SentenceTransformer uses for a model.
+    
+    The model's sentence_bert_config.json is copied into the ONNX export
+    directory on first use, so later starts work offline.
+    
+    Returns:
+        Token limit, or None if the model doesn't define one
+    """
+    config_path = export_dir / SENTENCE_BERT_CONFIG
+    if not config_path.exists():
+        from huggingface_hub import hf_hub_download
+        
+        try:
+            shutil.copy(hf_hub_download(model_id, SENTENCE_BERT_CONFIG), config_path)
+        except Exception as e:
+            logger.warning(f"No {SENTENCE_BERT_CONFIG} for {model_id}, using the tokenizer's limit: {e}")
+            return None
+    
+    with open(config_path) as f:
+        return json.load(f).get("max_seq_length")
+
+
+class OnnxEmbeddingModel:
+    """
+    Sentence embedding model served by ONNX Runtime on CPU.
+    
+    Implements the subset of SentenceTransformer.encode() used by the API
+    (mean pooling over the attention mask, optional L2 normalization), so
+    it can stand in for the torch model. The exported ONNX graph is cached
+    under settings.onnx_cache_dir so only the first start pays for export
+    (and quantization, when enabled).
+    """
+    
+    def __init__(self, model_name: str, quantize: bool = False):
+        # Imported lazily so the default torch backend doesn't need optimum
+        import onnxruntime
+        from optimum.onnxruntime import ORTModelForFeatureExtraction, ORTQuantizer
+        from optimum.onnxruntime.configuration import AutoQuantizationConfig
+        from transformers import AutoTokenizer
+        
+        # Short names resolve like SentenceTransformer does
+        model_id = model_name if "/" in model_name else f"sentence-transformers/{model_name}"
+        export_dir = Path(settings.onnx_cache_dir) / "onnx" / model_id.replace("/", "__")
+        
+        if not (export_dir / "model.onnx").exists():
+            logger.info(f"Exporting {model_id} to ONNX (first run only)...")
+            ORTModelForFeatureExtraction.from_pretrained(model_id, export=True).save_pretrained(export_dir)
+            AutoTokenizer.from_pretrained(model_id).save_pretrained(export_dir)
+        
+        file_name = "model.onnx"
+        if quantize:
+            # Dynamic int8 quantization: weights are stored as int8 and
+            # matmuls use VNNI instructions where the CPU supports them
+            file_name = "model_quantized.onnx"
+            if not (export_dir / file_name).exists():
+                logger.info("Quantizing ONNX model to int8 (first run only)...")
+                quantizer = ORTQuantizer.from_pretrained(export_dir, file_name="model.onnx")
+                quantizer.quantize(
+                    save_dir=export_dir,
+                    quantization_config=AutoQuantizationConfig.avx512_vnni(
+                        is_static=False, per_channel=False
+                    )
+                )
+        
+        session_options = onnxruntime.SessionOptions()
+        session_options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        
+        logger.info(f"Loading ONNX model {export_dir / file_name}")
+        self.model = ORTModelForFeatureExtraction.from_pretrained(
+            export_dir,
+            file_name=file_name,
+            provider="CPUExecutionProvider",
+            session_options=session_options
+        )
+        self.tokenizer = AutoTokenizer.from_pretrained(export_dir)
+        # Truncate where the torch model does (256 tokens for all-MiniLM-L6-v2,
+        # not the tokenizer's 512), so both backends embed long texts alike
+        self.max_seq_length = (
+            _sentence_transformer_max_seq_length(model_id, export_dir)
+            or min(self.tokenizer.model_max_length, 512)
+        )
+    
+    def encode(
+        self,
+        sentences: Union[str, List[str]],
+        batch_size: int = 32,
+        show_progress_bar: bool = False,
+        convert_to_numpy: bool = True,
+        normalize_embeddings: bool = False
+    ) -> np.ndarray:
+        """
+        Encode one sentence or a list of sentences.
+        
+        Returns:
+            A 1-D array for a single sentence, otherwise a 2-D array with
+            one row per sentence
+        """
+        single = isinstance(sentences, str)
+        texts = [sentences] if single else list(sentences)
+        
+        # Encode in length-sorted order (longest first, like
+        # SentenceTransformer) so each chunk pads to similar lengths
+        order = np.argsort([-len(text) for text in texts], kind="stable")
+        texts = [texts[i] for i in order]
+        
+        chunks = []
+        for start in range(0, len(texts), batch_size):
+            inputs = self.tokenizer(
+                texts[start:start + batch_size],
+                padding=True,
+                truncation=True,
+                max_length=self.max_seq_length,
+                return_tensors="np"
+            )
+            hidden = self.model(**inputs).last_hidden_state
+            
+            # Mean pooling over real (non-padding) tokens
+            mask = inputs["attention_mask"][..., None].astype(np.float32)
+            pooled = (hidden * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+            chunks.append(pooled.astype(np.float32))
+        
+        embeddings = np.concatenate(chunks) if chunks else np.empty((0, 0), dtype=np.float32)
+        # Restore the caller's order
+        embeddings[order] = embeddings.copy()
+        if normalize_embeddings and len(embeddings):
+            embeddings /= np.linalg.norm(embeddings, axis=1, keepdims=True).clip(1e-12)
+        
+        return embeddings[0] if single else embeddings
+
+
+EmbeddingModel = Union[SentenceTransformer, OnnxEmbeddingModel]
+
 # Global model instance
-_model: Optional[SentenceTransformer] = None
+_model: Optional[EmbeddingModel] = None
 
 
-def load_model() -> SentenceTransformer:
+def load_model() -> EmbeddingModel:
     """
-    Load the embedding model.
+    Load the embedding model for the configured backend.
     
     Returns:
-        Loaded SentenceTransformer model
+        Loaded SentenceTransformer, or OnnxEmbeddingModel when
+        settings.embedding_backend is "onnx"
     """
     global _model
     
     if _model is not None:
         return _model
     
-    logger.info(f"Loading embedding model: {settings.embedding_model}")
+    logger.info(f"Loading embedding model: {settings.embedding_model} (backend: {settings.embedding_backend})")
     try:
-        _model = SentenceTransformer(settings.embedding_model)
+        if settings.embedding_backend == "onnx":
+            _model = OnnxEmbeddingModel(
+                settings.embedding_model,
+                quantize=settings.embedding_onnx_quantize
+            )
+        else:
+            if settings.embedding_num_threads:
+                import torch
+                torch.set_num_threads(settings.embedding_num_threads)
+            
+            _model = SentenceTransformer(settings.embedding_model)
+            
+            # FP16 halves weight bandwidth on GPU; CPU inference stays FP32
+            if _model.device.type == "cuda":
+                _model.half()
+                logger.info("Using FP16 weights on CUDA")
+        _model.max_seq_length = settings.embedding_max_seq_length
         logger.info("✅ Embedding model loaded successfully")
         
-        # Pre-warm the model by encoding a dummy query
+        # Pre-warm the model with dummy queries of typical lengths
         logger.info("Pre-warming model...")
-        _model.encode("warmup", show_progress_bar=False)
+        for length in _WARMUP_LENGTHS:
+            _model.encode(" ".join(["book"] * length), show_progress_bar=False)
         logger.info("✅ Model pre-warmed")
         
         return _model
@@ -42,12 +210,12 @@ def load_model() -> SentenceTransformer:
         raise
 
 
-def get_model() -> SentenceTransformer:
+def get_model() -> EmbeddingModel:
     """
     Get the embedding model instance.
     
     Returns:
-        SentenceTransformer model instance
+        Embedding model instance
         
     Raises:
         RuntimeError: If model is not loaded
@@ -57,17 +225,74 @@ def get_model() -> SentenceTransformer:
     return _model
 
 
-def encode_query(query: str) -> list[float]:
+def unload_model() -> None:
+    """
+    Release the embedding model at shutdown.
+    
+    Drops the global reference, collects it, and on Linux asks glibc to
+    hand freed heap pages back to the OS, so a worker being replaced
+    doesn't hold the old model's memory while the new one loads.
+    """
+    global _model
+    
+    if _model is None:
+        return
+    
+    _model = None
+    gc.collect()
+    if sys.platform.startswith("linux"):
+        try:
+            ctypes.CDLL("libc.so.6").malloc_trim(0)
+        except (OSError, AttributeError):
+            # Not glibc (e.g. musl); freed memory is reused by the allocator
+            pass
+    logger.info("✅ Embedding model unloaded")
+
+
+def encode_texts(texts: List[str]) -> np.ndarray:
+    """
+    Encode several texts in a single forward pass.
+    
+    Blocking; call from a worker thread when on the event loop.
+    
+    Args:
+        texts: Texts to encode
+        
+    Returns:
+        float32 array with one normalized embedding row per text
+    """
+    model = get_model()
+    embeddings = model.encode(
+        texts,
+        batch_size=len(texts),
+        show_progress_bar=False,
+        convert_to_numpy=True,
+        normalize_embeddings=True
+    )
+    return embeddings.astype(np.float32, copy=False)
+
+
+async def encode_query(query: str) -> np.ndarray:
     """
     Encode a text query into an embedding vector.
     
+    The forward pass is CPU/GPU bound, so it runs in a worker thread to
+    keep the event loop free for other requests.
+    
     Args:
         query: Text query to encode
         
     Returns:
-        Embedding vector as a list of floats
+        Embedding vector as a float32 numpy array, bound directly as a
+        pgvector parameter by the adapters registered in api.database
     """
     model = get_model()
-    embedding = model.encode(query, show_progress_bar=False, convert_to_numpy=True)
-    return embedding.tolist()
+    embedding = await asyncio.to_thread(
+        model.encode,
+        query,
+        show_progress_bar=False,
+        convert_to_numpy=True,
+        normalize_embeddings=True
+    )
+    return embedding.astype(np.float32, copy=False)
 
@@ -0,0 +1,168 @@
+"""
+Micro-batching for query encoding.
+
+Concurrent /recommend requests each need one query embedding. Rather than
+running a forward pass per request, queries are queued and encoded
+together: the batcher waits up to settings.embedding_batch_max_wait_ms
+after the first queued query (or until embedding_batch_max_size queries
+are waiting), runs a single model.encode() in a worker thread, and hands
+each caller its row of the result.
+"""
+import asyncio
+import logging
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+from api.cache import get_cached_embedding, set_cached_embedding
+from api.config import settings
+from api.embedding import encode_query, encode_texts
+
+logger = logging.getLogger(__name__)
+
+# Pending (query, future) pairs waiting to be encoded
+_queue: Optional["asyncio.Queue[Tuple[str, asyncio.Future]]"] = None
+
+# Background task draining the queue
+_worker: Optional[asyncio.Task] = None
+
+# Set by stop_batcher(); new queries are rejected until the next start
+_stopped = False
+
+
+def _fail_pending(batch: List[Tuple[str, asyncio.Future]]) -> None:
+    """Fail the unresolved futures in a batch so their callers don't hang."""
+    for _, future in batch:
+        if not future.done():
+            future.set_exception(RuntimeError("Embedding batcher stopped"))
+
+
+async def _collect_batch(batch: List[Tuple[str, asyncio.Future]]) -> None:
+    """
+    Wait for one queued query, then gather more until the batch is full or the window closes.
+    
+    Fills the caller's list in place, so queries already taken off the
+    queue can still be failed if the batcher is cancelled mid-collection.
+    """
+    loop = asyncio.get_running_loop()
+    batch.append(await _queue.get())
+    deadline = loop.time() + settings.embedding_batch_max_wait_ms / 1000
+    
+    while len(batch) < settings.embedding_batch_max_size:
+        timeout = deadline - loop.time()
+        if timeout <= 0:
+            break
+        try:
+            batch.append(await asyncio.wait_for(_queue.get(), timeout))
+        except asyncio.TimeoutError:
+            break
+
+
+async def _run_batcher() -> None:
+    """Encode queued queries in batches until cancelled."""
+    while True:
+        batch: List[Tuple[str, asyncio.Future]] = []
+        try:
+            await _collect_batch(batch)
+            
+            # Callers that gave up (e.g. cancelled requests) don't need encoding
+            batch = [(text, future) for text, future in batch if not future.done()]
+            if not batch:
+                continue
+            
+            embeddings = await asyncio.to_thread(encode_texts, [text for text, _ in batch])
+        except asyncio.CancelledError:
+            _fail_pending(batch)
+            raise
+        except Exception as e:
+            logger.error(f"Failed to encode batch of {len(batch)} queries: {e}")
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            continue
+        
+        logger.debug(f"Encoded batch of {len(batch)} queries")
+        for (_, future), embedding in zip(batch, embeddings):
+            if not future.done():
+                # Copy the row so a cached embedding doesn't keep the whole
+                # batch matrix alive
+                future.set_result(embedding.copy())
+
+
+def start_batcher() -> None:
+    """Start the background batcher. Call after the model is loaded."""
+    global _queue, _worker, _stopped
+    
+    if _worker is not None:
+        logger.warning("Embedding batcher already started")
+        return
+    
+    _stopped = False
+    _queue = asyncio.Queue()
+    _worker = asyncio.create_task(_run_batcher())
+    logger.info(
+        f"Embedding batcher started (max_size={settings.embedding_batch_max_size}, "
+        f"max_wait={settings.embedding_batch_max_wait_ms}ms)"
+    )
+
+
+async def stop_batcher() -> None:
+    """
+    Stop the background batcher and fail any queries still waiting.
+    
+    Queries being collected or encoded when the batcher is cancelled fail
+    too, and submit_encode() rejects new queries from then on.
+    """
+    global _queue, _worker, _stopped
+    
+    if _worker is None:
+        return
+    
+    _stopped = True
+    _worker.cancel()
+    try:
+        await _worker
+    except asyncio.CancelledError:
+        pass
+    
+    while not _queue.empty():
+        _fail_pending([_queue.get_nowait()])
+    
+    _queue = None
+    _worker = None
+    logger.info("Embedding batcher stopped")
+
+
+async def submit_encode(query: str) -> np.ndarray:
+    """
+    Encode a query, batched with other concurrent queries.
+    
+    Repeated queries are served from the embedding cache without running
+    the model. Falls back to encoding the query on its own if the batcher
+    was never started.
+    
+    Args:
+        query: Text query to encode
+        
+    Returns:
+        Embedding vector as a float32 numpy array
+    
+    Raises:
+        RuntimeError: If the batcher has been stopped (shutting down)
+    """
+    embedding = get_cached_embedding(query)
+    if embedding is not None:
+        return embedding
+    
+    if _stopped:
+        raise RuntimeError("Embedding batcher stopped")
+    
+    if _queue is None:
+        embedding = await encode_query(query)
+    else:
+        future = asyncio.get_running_loop().create_future()
+        await _queue.put((query, future))
+        embedding = await future
+    
+    set_cached_embedding(query, embedding)
+    return embedding
@@ -3,27 +3,43 @@ WhatToRead API - FastAPI Application
 """
 import logging
 from contextlib import asynccontextmanager
+from typing import Any
 
-from fastapi import FastAPI, HTTPException, Request, status
+import msgspec
+from fastapi import FastAPI, HTTPException, Request, Response, status
 from fastapi.exceptions import RequestValidationError
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.middleware.gzip import GZipMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import ORJSONResponse
 
 from api.cache import (
+    clear_all_caches,
     clear_book_cache,
+    cache_key_for_recommendation,
     clear_recommendation_cache,
+    clear_shared_recommendations,
+    close_shared_cache,
+    coalesce_recommendation,
     get_cached_book,
     get_cached_recommendation,
     get_cache_stats,
+    get_shared_recommendation,
+    init_shared_cache,
     set_cached_book,
     set_cached_recommendation,
+    set_shared_recommendation,
 )
 from api.config import settings, setup_logging
 from api.database import close_db_pool, init_db_pool
-from api.embedding import encode_query, load_model
-from api.middleware import RequestLoggingMiddleware
-from api.models import BookDetailResponse, BookResponse, RecommendationRequest
+from api.embedding import load_model, unload_model
+from api.embedding_batcher import start_batcher, stop_batcher, submit_encode
+from api.middleware import CompressionMiddleware, RequestLoggingMiddleware
+from api.models import (
+    BookDetailRecord,
+    BookDetailResponse,
+    BookRecord,
+    BookResponse,
+    RecommendationRequest,
+)
 from api.performance import get_performance_monitor, track_performance
 from api.queries import get_book_by_id, search_similar_books
 
@@ -31,6 +47,14 @@ from api.queries import get_book_by_id, search_similar_books
 setup_logging(settings.log_level, settings.log_file)
 logger = logging.getLogger(__name__)
 
+# Shared encoder for msgspec response structs
+_json_encoder = msgspec.json.Encoder()
+
+
+def _json_response(data: Any) -> Response:
+    """Encode msgspec structs (or lists of them) straight into a JSON response."""
+    return Response(content=_json_encoder.encode(data), media_type="application/json")
+
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
@@ -47,6 +71,8 @@ async def lifespan(app: FastAPI):
         logger.error(f"❌ Failed to initialize database pool: {e}")
         raise
     
+    await init_shared_cache()
+    
     # Load embedding model
     try:
         load_model()
@@ -54,13 +80,18 @@ async def lifespan(app: FastAPI):
         logger.error(f"❌ Failed to load embedding model: {e}")
         raise
     
+    start_batcher()
+    
     logger.info("✅ API startup complete")
     
     yield
     
     # Shutdown
     logger.info("🛑 Shutting down WhatToRead API...")
+    await stop_batcher()
     await close_db_pool()
+    await close_shared_cache()
+    unload_model()
     logger.info("✅ API shutdown complete")
 
 
@@ -70,12 +101,13 @@ app = FastAPI(
     description="Semantic book recommendation engine API using vector search",
     version=settings.app_version,
     lifespan=lifespan,
+    default_response_class=ORJSONResponse,
     docs_url="/docs",
     redoc_url="/redoc",
 )
 
-# Compression middleware (compress responses > 1KB)
-app.add_middleware(GZipMiddleware, minimum_size=1000)
+# Compression middleware (compress responses > 1KB off the event loop)
+app.add_middleware(CompressionMiddleware, minimum_size=1000)
 
 # CORS middleware
 # Note: If allow_origins=["*"], allow_credentials must be False
@@ -98,7 +130,7 @@ app.add_middleware(RequestLoggingMiddleware)
 async def validation_exception_handler(request: Request, exc: RequestValidationError):
     """Handle request validation errors."""
     logger.warning(f"Validation error on {request.url.path}: {exc.errors()}")
-    return JSONResponse(
+    return ORJSONResponse(
         status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
         content={
             "detail": "Validation error",
@@ -110,11 +142,16 @@ async def validation_exception_handler(request: Request, exc: RequestValidationE
 @app.exception_handler(Exception)
 async def general_exception_handler(request: Request, exc: Exception):
     """Handle unexpected exceptions."""
-    logger.error(
-        f"Unhandled exception on {request.url.path}: {exc}",
-        exc_info=True
-    )
-    return JSONResponse(
+    # Lazy %-formatting and the level check keep an exception storm (e.g.
+    # a database outage) from formatting tracebacks nobody will see
+    if logger.isEnabledFor(logging.ERROR):
+        logger.error(
+            "Unhandled exception on %s: %s",
+            request.url.path,
+            exc,
+            exc_info=exc
+        )
+    return ORJSONResponse(
         status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
         content={
             "detail": "Internal server error",
@@ -160,13 +197,14 @@ async def clear_cache(cache_type: str = "all"):
     """
     if cache_type == "recommendations":
         clear_recommendation_cache()
+        await clear_shared_recommendations()
         return {"message": "Recommendation cache cleared"}
     elif cache_type == "books":
         clear_book_cache()
         return {"message": "Book detail cache cleared"}
     elif cache_type == "all":
-        clear_recommendation_cache()
-        clear_book_cache()
+        clear_all_caches()
+        await clear_shared_recommendations()
         return {"message": "All caches cleared"}
     else:
         raise HTTPException(
@@ -210,6 +248,63 @@ async def root():
     }
 
 
+async def _build_recommendations(query: str, limit: int, cache_key: int) -> list[BookRecord]:
+    """
+    Compute and cache recommendations for a query on a local cache miss.
+    
+    The shared cache (if configured) is checked first, so only one worker
+    encodes and searches for a given query.
+    
+    Args:
+        query: Semantic query text
+        limit: Maximum number of recommendations
+        cache_key: Key from cache_key_for_recommendation()
+    
+    Returns:
+        List of BookRecord ordered by similarity
+    """
+    shared_result = await get_shared_recommendation(cache_key)
+    if shared_result is not None:
+        logger.debug(f"Shared cache hit for recommendation query: {query[:50]}...")
+        return shared_result
+    
+    # Encode the query into an embedding vector
+    logger.info(f"Processing recommendation request: query='{query[:50]}...', limit={limit}")
+    query_embedding = await submit_encode(query)
+    
+    # Search for similar books
+    results = await search_similar_books(
+        query_embedding=query_embedding,
+        limit=limit
+    )
+    
+    if not results:
+        logger.info("No books found matching the query")
+        empty_result = []
+        set_cached_recommendation(cache_key, empty_result)
+        await set_shared_recommendation(cache_key, empty_result)
+        return empty_result
+    
+    # Format response
+    books = []
+    for row in results:
+        book_id, ol_key, title, authors, year, subjects, similarity = row
+        books.append(BookRecord(
+            id=book_id,
+            ol_key=ol_key,
+            title=title,
+            authors=authors or [],
+            first_publish_year=year,
+            subjects=subjects or [],
+            similarity=float(similarity)
+        ))
+    
+    # Cache the result
+    set_cached_recommendation(cache_key, books)
+    await set_shared_recommendation(cache_key, books)
+    return books
+
+
 @app.post("/recommend", response_model=list[BookResponse], tags=["Recommendations"])
 async def get_recommendations(request: RecommendationRequest):
     """
@@ -234,50 +329,22 @@ async def get_recommendations(request: RecommendationRequest):
     """
     async with track_performance("/recommend", "POST") as metric:
         try:
-            # Check cache first
-            cached_result = get_cached_recommendation(request.query, request.limit)
+            # Check cache first; the key is hashed once and reused below
+            cache_key = cache_key_for_recommendation(request.query, request.limit)
+            cached_result = get_cached_recommendation(cache_key)
             if cached_result is not None:
                 logger.debug(f"Cache hit for recommendation query: {request.query[:50]}...")
                 metric.status_code = 200
-                return cached_result
-            
-            # Encode the query into an embedding vector
-            logger.info(f"Processing recommendation request: query='{request.query[:50]}...', limit={request.limit}")
-            query_embedding = encode_query(request.query)
+                return _json_response(cached_result)
             
-            # Search for similar books
-            results = await search_similar_books(
-                query_embedding=query_embedding,
-                limit=request.limit
+            books = await coalesce_recommendation(
+                cache_key,
+                lambda: _build_recommendations(request.query, request.limit, cache_key)
             )
             
-            if not results:
-                logger.info("No books found matching the query")
-                empty_result = []
-                set_cached_recommendation(request.query, request.limit, empty_result)
-                metric.status_code = 200
-                return empty_result
-            
-            # Format response
-            books = []
-            for row in results:
-                book_id, ol_key, title, authors, year, subjects, similarity = row
-                books.append(BookResponse(
-                    id=book_id,
-                    ol_key=ol_key,
-                    title=title,
-                    authors=authors or [],
-                    first_publish_year=year,
-                    subjects=subjects or [],
-                    similarity=float(similarity)
-                ))
-            
-            # Cache the result
-            set_cached_recommendation(request.query, request.limit, books)
-            
             logger.info(f"Returning {len(books)} recommendations")
             metric.status_code = 200
-            return books
+            return _json_response(books)
             
         except HTTPException:
             metric.status_code = 500
@@ -308,14 +375,16 @@ async def get_book(book_id: int):
     **Caching:**
     - Responses are cached for 1 hour to improve performance
     """
-    async with track_performance(f"/books/{book_id}", "GET") as metric:
+    # Tracked under the route template: per-ID keys would give every book
+    # its own stats entry (and percentile buffer) and grow without bound
+    async with track_performance("/books/{book_id}", "GET") as metric:
         try:
             # Check cache first
             cached_result = get_cached_book(book_id)
             if cached_result is not None:
                 logger.debug(f"Cache hit for book ID: {book_id}")
                 metric.status_code = 200
-                return cached_result
+                return _json_response(cached_result)
             
             logger.debug(f"Fetching book with ID: {book_id}")
             book = await get_book_by_id(book_id)
@@ -329,7 +398,7 @@ async def get_book(book_id: int):
             
             book_id, ol_key, title, authors, year, subjects, search_content = book
             
-            book_detail = BookDetailResponse(
+            book_detail = BookDetailRecord(
                 id=book_id,
                 ol_key=ol_key,
                 title=title,
@@ -343,7 +412,7 @@ async def get_book(book_id: int):
             set_cached_book(book_id, book_detail)
             
             metric.status_code = 200
-            return book_detail
+            return _json_response(book_detail)
             
         except HTTPException:
             raise
@@ -1,53 +1,177 @@
 """
-Custom middleware for request/response logging and error handling.
+Custom middleware for request/response logging, compression and error handling.
 """
+import asyncio
+import gzip
 import logging
 import time
-from typing import Callable
+from typing import Optional
 
-from fastapi import Request, Response
-from starlette.middleware.base import BaseHTTPMiddleware
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+try:
+    import zstandard
+except ImportError:  # Optional: responses fall back to gzip
+    zstandard = None
 
 logger = logging.getLogger(__name__)
 
 
-class RequestLoggingMiddleware(BaseHTTPMiddleware):
-    """Middleware to log HTTP requests and responses."""
+class RequestLoggingMiddleware:
+    """
+    Middleware to log HTTP requests and responses.
+    
+    Implemented as plain ASGI rather than BaseHTTPMiddleware, which adds an
+    extra task and memory stream per request.
+    """
+    
+    def __init__(self, app: ASGIApp) -> None:
+        self.app = app
     
-    async def dispatch(self, request: Request, call_next: Callable) -> Response:
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        
         # Start timer
-        start_time = time.time()
+        start_time = time.perf_counter()
+        method = scope["method"]
+        path = scope["path"]
+        client = scope.get("client")
         
         # Log request
         logger.info(
-            f"{request.method} {request.url.path} - "
-            f"Client: {request.client.host if request.client else 'unknown'}"
+            f"{method} {path} - "
+            f"Client: {client[0] if client else 'unknown'}"
         )
         
+        status_code = 500
+        
+        async def send_with_status(message: Message) -> None:
+            # Capture the status code as the response starts
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+        
         # Process request
         try:
-            response = await call_next(request)
-            
-            # Calculate duration
-            duration = time.time() - start_time
-            
-            # Log response
-            logger.info(
-                f"{request.method} {request.url.path} - "
-                f"Status: {response.status_code} - "
-                f"Duration: {duration:.3f}s"
-            )
-            
-            return response
-            
+            await self.app(scope, receive, send_with_status)
         except Exception as e:
             # Log error
-            duration = time.time() - start_time
+            duration = time.perf_counter() - start_time
             logger.error(
-                f"{request.method} {request.url.path} - "
+                f"{method} {path} - "
                 f"Error: {str(e)} - "
                 f"Duration: {duration:.3f}s",
                 exc_info=True
             )
             raise
+        
+        # Calculate duration
+        duration = time.perf_counter() - start_time
+        
+        # Log response
+        logger.info(
+            f"{method} {path} - "
+            f"Status: {status_code} - "
+            f"Duration: {duration:.3f}s"
+        )
+
+
+def _negotiate_encoding(accept_encoding: str) -> Optional[str]:
+    """
+    Pick the response encoding from an Accept-Encoding header.
+    
+    Args:
+        accept_encoding: Raw Accept-Encoding header value
+        
+    Returns:
+        "zstd", "gzip", or None if the client accepts neither
+    """
+    accepted = set()
+    for part in accept_encoding.split(","):
+        coding, _, params = part.partition(";")
+        _, _, quality = params.partition("q=")
+        try:
+            # Explicitly refused codings (q=0) are skipped
+            if quality and float(quality) == 0:
+                continue
+        except ValueError:
+            continue
+        accepted.add(coding.strip().lower())
+    
+    if zstandard is not None and "zstd" in accepted:
+        return "zstd"
+    if "gzip" in accepted:
+        return "gzip"
+    return None
+
 
+def _compress(body: bytes, encoding: str) -> bytes:
+    """Compress a response body with the negotiated encoding."""
+    if encoding == "zstd":
+        # Compressors aren't thread-safe, so each call gets its own
+        return zstandard.ZstdCompressor(level=3).compress(body)
+    return gzip.compress(body, compresslevel=6)
+
+
+class CompressionMiddleware:
+    """
+    Middleware to compress response bodies larger than minimum_size.
+    
+    Replaces GZipMiddleware, which compresses on the event loop. Here the
+    compression runs in a worker thread (zlib and zstd release the GIL),
+    so a large /recommend payload doesn't stall other requests. Streaming
+    responses are passed through uncompressed.
+    """
+    
+    def __init__(self, app: ASGIApp, minimum_size: int = 1000) -> None:
+        self.app = app
+        self.minimum_size = minimum_size
+    
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        
+        encoding = _negotiate_encoding(Headers(scope=scope).get("accept-encoding", ""))
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+        
+        start_message: Optional[Message] = None
+        passthrough = False
+        
+        async def send_compressed(message: Message) -> None:
+            nonlocal start_message, passthrough
+            if passthrough:
+                await send(message)
+                return
+            
+            # Hold the headers back until the body size is known
+            if message["type"] == "http.response.start":
+                start_message = message
+                return
+            
+            body = message.get("body", b"")
+            headers = MutableHeaders(raw=start_message["headers"])
+            if (
+                message.get("more_body", False)
+                or len(body) < self.minimum_size
+                or "content-encoding" in headers
+            ):
+                passthrough = True
+                await send(start_message)
+                await send(message)
+                return
+            
+            compressed = await asyncio.to_thread(_compress, body, encoding)
+            headers["Content-Encoding"] = encoding
+            headers["Content-Length"] = str(len(compressed))
+            headers.add_vary_header("Accept-Encoding")
+            await send(start_message)
+            await send({"type": "http.response.body", "body": compressed})
+        
+        await self.app(scope, receive, send_compressed)
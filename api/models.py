@@ -1,8 +1,10 @@
 """
-Pydantic models for request/response validation.
+Pydantic models for request/response validation, plus msgspec structs used
+to build and serialize responses on the hot path.
 """
 from typing import List, Optional
 
+import msgspec
 from pydantic import BaseModel, Field, field_validator
 
 
@@ -94,3 +96,32 @@ class BookDetailResponse(BaseModel):
         }
     }
 
+
+class BookRecord(msgspec.Struct, frozen=True):
+    """
+    A single book in a /recommend response.
+    
+    Mirrors BookResponse, which stays the documented response_model. Rows
+    are built as structs and encoded with msgspec, skipping per-row
+    Pydantic validation.
+    """
+    
+    id: int
+    ol_key: str
+    title: str
+    authors: List[str]
+    first_publish_year: Optional[int]
+    subjects: List[str]
+    similarity: float
+
+
+class BookDetailRecord(msgspec.Struct, frozen=True):
+    """A /books/{id} response. Mirrors BookDetailResponse."""
+    
+    id: int
+    ol_key: str
+    title: str
+    authors: List[str]
+    first_publish_year: Optional[int]
+    subjects: List[str]
+    search_content: Optional[str]
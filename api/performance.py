@@ -3,16 +3,23 @@ Performance monitoring utilities for API endpoints.
 """
 import logging
 import time
+from collections import defaultdict, deque
 from contextlib import asynccontextmanager
 from dataclasses import dataclass, field
-from typing import Dict, List
+from typing import Deque, Dict, Tuple
+
+import numpy as np
 
 logger = logging.getLogger(__name__)
 
 
-@dataclass
+@dataclass(slots=True)
 class PerformanceMetric:
-    """Represents a single performance metric."""
+    """
+    Represents a single performance metric.
+    
+    One is created per request; slots drop the per-instance __dict__.
+    """
     endpoint: str
     method: str
     duration_ms: float
@@ -20,6 +27,47 @@ class PerformanceMetric:
     timestamp: float = field(default_factory=time.time)
 
 
+# Number of recent durations kept per endpoint for percentile estimates
+RECENT_WINDOW = 100
+
+
+@dataclass(slots=True)
+class EndpointStats:
+    """Running aggregates for one endpoint, updated on every record."""
+    count: int = 0
+    total_ms: float = 0.0
+    min_ms: float = float("inf")
+    max_ms: float = 0.0
+    # Ring buffer of recent durations; count doubles as the write index
+    recent: np.ndarray = field(default_factory=lambda: np.empty(RECENT_WINDOW, dtype=np.float32))
+    
+    def add(self, duration_ms: float) -> None:
+        """Fold a new duration into the aggregates."""
+        self.recent[self.count % RECENT_WINDOW] = duration_ms
+        self.count += 1
+        self.total_ms += duration_ms
+        if duration_ms < self.min_ms:
+            self.min_ms = duration_ms
+        if duration_ms > self.max_ms:
+            self.max_ms = duration_ms
+    
+    def percentiles(self, *fractions: float) -> Tuple[float, ...]:
+        """
+        Estimate percentiles over the recent window.
+        
+        Uses linear interpolation between the closest ranks, so small
+        windows aren't biased low by truncating the index.
+        
+        Args:
+            fractions: Percentiles as fractions, e.g. 0.95, 0.99
+            
+        Returns:
+            Durations in milliseconds, one per fraction
+        """
+        window = self.recent[:min(self.count, RECENT_WINDOW)]
+        return tuple(float(q) for q in np.quantile(window, fractions))
+
+
 class PerformanceMonitor:
     """Monitor and track API performance metrics."""
     
@@ -30,33 +78,26 @@ class PerformanceMonitor:
         Args:
             max_metrics: Maximum number of metrics to store in memory
         """
-        self.metrics: List[PerformanceMetric] = []
+        # Bounded deques drop the oldest entry in O(1) once full
+        self.metrics: Deque[PerformanceMetric] = deque(maxlen=max_metrics)
         self.max_metrics = max_metrics
-        self._metrics_by_endpoint: Dict[str, List[float]] = {}
+        # Keyed by (method, endpoint) so recording needs no string formatting
+        self._metrics_by_endpoint: Dict[Tuple[str, str], EndpointStats] = defaultdict(EndpointStats)
     
     def record(self, metric: PerformanceMetric):
         """Record a performance metric."""
         self.metrics.append(metric)
         
-        # Maintain max size
-        if len(self.metrics) > self.max_metrics:
-            self.metrics.pop(0)
-        
         # Track by endpoint for statistics
-        key = f"{metric.method} {metric.endpoint}"
-        if key not in self._metrics_by_endpoint:
-            self._metrics_by_endpoint[key] = []
-        
-        self._metrics_by_endpoint[key].append(metric.duration_ms)
-        
-        # Keep only recent metrics per endpoint (last 100)
-        if len(self._metrics_by_endpoint[key]) > 100:
-            self._metrics_by_endpoint[key].pop(0)
+        self._metrics_by_endpoint[(metric.method, metric.endpoint)].add(metric.duration_ms)
     
     def get_endpoint_stats(self, endpoint: str, method: str = "GET") -> Dict[str, float]:
         """
         Get statistics for a specific endpoint.
         
+        Count, average, min and max cover every recorded request;
+        p95/p99 are estimated from the most recent RECENT_WINDOW.
+        
         Args:
             endpoint: Endpoint path
             method: HTTP method
@@ -64,10 +105,9 @@ class PerformanceMonitor:
         Returns:
             Dictionary with statistics (count, avg, min, max, p95, p99)
         """
-        key = f"{method} {endpoint}"
-        durations = self._metrics_by_endpoint.get(key, [])
+        stats = self._metrics_by_endpoint.get((method, endpoint))
         
-        if not durations:
+        if stats is None or stats.count == 0:
             return {
                 "count": 0,
                 "avg_ms": 0.0,
@@ -77,16 +117,15 @@ class PerformanceMonitor:
                 "p99_ms": 0.0
             }
         
-        sorted_durations = sorted(durations)
-        count = len(sorted_durations)
+        p95, p99 = stats.percentiles(0.95, 0.99)
         
         return {
-            "count": count,
-            "avg_ms": sum(sorted_durations) / count,
-            "min_ms": sorted_durations[0],
-            "max_ms": sorted_durations[-1],
-            "p95_ms": sorted_durations[int(count * 0.95)] if count > 0 else 0.0,
-            "p99_ms": sorted_durations[int(count * 0.99)] if count > 0 else 0.0
+            "count": stats.count,
+            "avg_ms": stats.total_ms / stats.count,
+            "min_ms": stats.min_ms,
+            "max_ms": stats.max_ms,
+            "p95_ms": p95,
+            "p99_ms": p99
         }
     
     def get_all_stats(self) -> Dict[str, Dict[str, float]]:
@@ -94,12 +133,11 @@ class PerformanceMonitor:
         Get statistics for all endpoints.
         
         Returns:
-            Dictionary mapping endpoint keys to statistics
+            Dictionary mapping "METHOD /path" keys to statistics
         """
         stats = {}
-        for key in self._metrics_by_endpoint.keys():
-            method, endpoint = key.split(" ", 1)
-            stats[key] = self.get_endpoint_stats(endpoint, method)
+        for method, endpoint in self._metrics_by_endpoint.keys():
+            stats[f"{method} {endpoint}"] = self.get_endpoint_stats(endpoint, method)
         
         return stats
     
@@ -1,11 +1,12 @@
 """
 Database query functions for book recommendations.
 """
-import asyncio
 import logging
 from typing import List, Optional, Tuple
 
+import numpy as np
 import psycopg
+from pgvector import HalfVector
 
 from api.config import settings
 from api.database import get_db_connection
@@ -14,15 +15,19 @@ logger = logging.getLogger(__name__)
 
 
 async def search_similar_books(
-    query_embedding: List[float],
+    query_embedding: np.ndarray,
     limit: int = 10,
     similarity_threshold: Optional[float] = None
 ) -> List[Tuple]:
     """
     Search for books similar to the query embedding using vector cosine similarity.
     
+    Stored and query embeddings are L2-normalized, so cosine similarity
+    equals their inner product and the search uses pgvector's cheaper
+    inner-product operator (and the matching halfvec_ip_ops index).
+    
     Args:
-        query_embedding: Embedding vector for the query
+        query_embedding: float32 embedding vector for the query
         limit: Maximum number of results to return
         similarity_threshold: Cosine distance threshold (None uses default from settings)
     
@@ -34,8 +39,13 @@ async def search_similar_books(
     # Ensure limit doesn't exceed maximum
     limit = min(limit, settings.max_recommendations)
     
-    # SQL query using pgvector cosine distance operator (<=>)
-    # 1 - (embedding <=> query) gives us similarity (higher is more similar)
+    # SQL query using pgvector negative inner product operator (<#>).
+    # For unit vectors, cosine distance is 1 + (embedding <#> query) and
+    # similarity is -(embedding <#> query), so results and the threshold
+    # keep their cosine meaning without computing norms per comparison.
+    # The distance is computed once per row in the subquery; ordering by
+    # it still uses the vector index, and filtering the nearest `limit`
+    # rows by threshold gives the same result as filtering first.
     sql = """
         SELECT 
             id,
@@ -44,23 +54,36 @@ async def search_similar_books(
             authors,
             first_publish_year,
             subjects,
-            1 - (embedding <=> %s::vector) as similarity
-        FROM books
-        WHERE embedding <=> %s::vector < %s
-        ORDER BY embedding <=> %s::vector
-        LIMIT %s;
+            -neg_inner_product as similarity
+        FROM (
+            SELECT 
+                id,
+                ol_key,
+                title,
+                authors,
+                first_publish_year,
+                subjects,
+                embedding <#> %s as neg_inner_product
+            FROM books
+            ORDER BY neg_inner_product
+            LIMIT %s
+        ) nearest
+        WHERE 1 + neg_inner_product < %s
+        ORDER BY neg_inner_product;
     """
     
+    # The embedding column is halfvec, so send the query as float16 too:
+    # half the bytes on the wire, and the binary parameter is typed as
+    # halfvec by the pgvector adapters, so the SQL needs no cast
+    query_embedding = HalfVector(query_embedding)
+    
+    # prepare=True makes the server keep the parsed and planned statement on
+    # first use instead of after psycopg's default five executions; ef_search
+    # is fixed per session, so the cached plan stays valid
     async with get_db_connection() as conn:
-        def execute_query():
-            with conn.cursor() as cur:
-                cur.execute(
-                    sql,
-                    (query_embedding, query_embedding, threshold, query_embedding, limit)
-                )
-                return cur.fetchall()
-        
-        results = await asyncio.to_thread(execute_query)
+        async with conn.cursor() as cur:
+            await cur.execute(sql, (query_embedding, limit, threshold), prepare=True)
+            results = await cur.fetchall()
     
     logger.debug(f"Found {len(results)} similar books for query")
     return results
@@ -91,12 +114,9 @@ async def get_book_by_id(book_id: int) -> Optional[Tuple]:
     """
     
     async with get_db_connection() as conn:
-        def execute_query():
-            with conn.cursor() as cur:
-                cur.execute(sql, (book_id,))
-                return cur.fetchone()
-        
-        result = await asyncio.to_thread(execute_query)
+        async with conn.cursor() as cur:
+            await cur.execute(sql, (book_id,), prepare=True)
+            result = await cur.fetchone()
     
     return result
 
@@ -126,19 +146,46 @@ async def get_book_by_ol_key(ol_key: str) -> Optional[Tuple]:
     """
     
     async with get_db_connection() as conn:
-        def execute_query():
-            with conn.cursor() as cur:
-                cur.execute(sql, (ol_key,))
-                return cur.fetchone()
-        
-        result = await asyncio.to_thread(execute_query)
+        async with conn.cursor() as cur:
+            await cur.execute(sql, (ol_key,))
+            result = await cur.fetchone()
     
     return result
 
 
 async def get_books_count() -> int:
     """
-    Get the total number of books in the database.
+    Get the approximate number of books in the database.
+    
+    Reads the planner's row estimate (kept current by ANALYZE and
+    autovacuum) instead of scanning the table; it is usually within a
+    few percent. Falls back to an exact count if the table has never
+    been analyzed.
+    
+    Returns:
+        Estimated count of books
+    """
+    sql = "SELECT reltuples::bigint FROM pg_class WHERE oid = to_regclass('books');"
+    
+    async with get_db_connection() as conn:
+        async with conn.cursor() as cur:
+            await cur.execute(sql)
+            result = await cur.fetchone()
+    
+    if not result:
+        return 0
+    # reltuples is -1 until the first ANALYZE (Postgres 14+)
+    if result[0] < 0:
+        return await get_books_count_exact()
+    return result[0]
+
+
+async def get_books_count_exact() -> int:
+    """
+    Get the exact number of books in the database.
+    
+    Runs COUNT(*), which scans the whole table; prefer get_books_count()
+    unless an exact figure is required.
     
     Returns:
         Total count of books
@@ -146,12 +193,8 @@ async def get_books_count() -> int:
     sql = "SELECT COUNT(*) FROM books;"
     
     async with get_db_connection() as conn:
-        def execute_query():
-            with conn.cursor() as cur:
-                cur.execute(sql)
-                return cur.fetchone()
-        
-        result = await asyncio.to_thread(execute_query)
+        async with conn.cursor() as cur:
+            await cur.execute(sql)
+            result = await cur.fetchone()
     
     return result[0] if result else 0
-
@@ -7,16 +7,25 @@ Ingests Open Library works dump, filters for quality, generates embeddings, and
 import os
 import sys
 import gzip
-import json
 import logging
-import time
+import queue
+import shutil
+import subprocess
+import threading
+from contextlib import contextmanager
 from pathlib import Path
-from typing import Dict, List, Optional, Tuple
+from typing import BinaryIO, Callable, Dict, Iterator, List, Optional, Tuple
 
+import orjson
 import psycopg
+from pgvector import HalfVector
+from pgvector.psycopg import register_vector
 from sentence_transformers import SentenceTransformer
 from tqdm import tqdm
 
+# Add parent directory to path so the ONNX backend can reuse the API's encoder
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
 # Configuration
 DUMP_FILE = os.getenv(
     "DUMP_FILE", 
@@ -24,11 +33,17 @@ DUMP_FILE = os.getenv(
 )
 DATABASE_URL = os.getenv("DATABASE_URL")
 MODEL_NAME = os.getenv("EMBEDDING_MODEL", "all-MiniLM-L6-v2")
-BATCH_SIZE = int(os.getenv("BATCH_SIZE", "250"))  # Conservative default for low memory usage
+# Records per batch; the model sorts each batch by length before encoding,
+# so larger batches mean less padding. Activation memory is bounded by
+# EMBEDDING_BATCH_SIZE, not this.
+BATCH_SIZE = int(os.getenv("BATCH_SIZE", "2000"))
 MIN_SUBJECTS = int(os.getenv("MIN_SUBJECTS", "3"))
+MIN_TEXT_LENGTH = int(os.getenv("MIN_TEXT_LENGTH", "10"))  # Shorter embedding texts aren't worth encoding
 MAX_RECORDS = int(os.getenv("MAX_RECORDS", "0"))  # 0 = no limit, process all
-BATCH_DELAY = float(os.getenv("BATCH_DELAY", "0.2"))  # Delay between batches (seconds) to reduce CPU load
+PIPELINE_DEPTH = int(os.getenv("PIPELINE_DEPTH", "4"))  # Batches buffered between pipeline stages
 EMBEDDING_BATCH_SIZE = int(os.getenv("EMBEDDING_BATCH_SIZE", "32"))  # Smaller embedding batches for lower memory
+EMBEDDING_BACKEND = os.getenv("EMBEDDING_BACKEND", "torch")  # "torch" or "onnx" (ONNX Runtime, CPU)
+EMBEDDING_ONNX_QUANTIZE = os.getenv("EMBEDDING_ONNX_QUANTIZE", "false").lower() in ("1", "true", "yes")
 
 # Setup logging
 logging.basicConfig(
@@ -67,75 +82,125 @@ def is_quality_record(work: Dict) -> bool:
 
 
 def extract_authors(work: Dict) -> List[str]:
-    """Extract author names from work record."""
+    """
+    Extract author keys from work record.
+    
+    Called for every quality record, so it indexes optimistically and
+    lets the rare malformed entry raise instead of type-checking each one.
+    """
     authors = []
-    author_list = work.get("authors", [])
-    
-    for author_entry in author_list:
-        if isinstance(author_entry, dict):
-            # Handle author role structure: {"author": {"key": "/authors/OL123A"}}
-            author = author_entry.get("author", {})
-            if isinstance(author, dict):
-                author_key = author.get("key", "")
-                # Extract author name from key or use key itself
-                if author_key.startswith("/authors/"):
-                    authors.append(author_key)
-            # Handle direct author key
-            elif "key" in author_entry:
+    
+    for author_entry in work.get("authors", ()):
+        try:
+            # Author role structure: {"author": {"key": "/authors/OL123A"}}
+            author_key = author_entry["author"]["key"]
+        except KeyError:
+            continue
+        except TypeError:
+            # Direct author key alongside a non-dict "author" (or a non-dict entry)
+            if isinstance(author_entry, dict) and "key" in author_entry:
                 authors.append(author_entry["key"])
+            continue
+        
+        try:
+            if author_key.startswith("/authors/"):
+                authors.append(author_key)
+        except AttributeError:
+            continue
     
     return authors
 
 
 def extract_publish_year(work: Dict) -> Optional[int]:
     """Extract first publish year from work record."""
-    first_publish_date = work.get("first_publish_date")
-    
-    if isinstance(first_publish_date, dict):
-        value = first_publish_date.get("value")
-        if value:
-            # Extract year from date string (format: "YYYY-MM-DD" or "YYYY")
-            try:
-                year_str = str(value)[:4]
-                return int(year_str) if year_str.isdigit() else None
-            except (ValueError, TypeError):
-                return None
+    try:
+        # Format: {"type": "/type/datetime", "value": "YYYY-MM-DD" or "YYYY"}
+        value = work["first_publish_date"]["value"]
+    except (KeyError, TypeError):
+        value = None
+    
+    if value:
+        # Extract year from date string (format: "YYYY-MM-DD" or "YYYY")
+        year_str = str(value)[:4]
+        try:
+            return int(year_str) if year_str.isdigit() else None
+        except ValueError:
+            return None
     
     # Try alternative field
     first_publish_year = work.get("first_publish_year")
     if isinstance(first_publish_year, (int, str)):
         try:
             return int(str(first_publish_year)[:4])
-        except (ValueError, TypeError):
+        except ValueError:
             return None
     
     return None
 
 
-def parse_dump_line(line: str) -> Optional[Dict]:
-    """Parse a single line from the Open Library dump."""
+def parse_dump_line(line: bytes) -> Optional[Dict]:
+    """
+    Parse a single line from the Open Library dump.
+    
+    Works on raw bytes: orjson parses the JSON column without a UTF-8
+    decode of the whole line, and only the type/key columns are decoded
+    when the JSON lacks them.
+    """
     try:
         # Format: type\tkey\trevision\tlast_modified\t{json}
-        parts = line.strip().split("\t", 4)
+        parts = line.strip().split(b"\t", 4)
         if len(parts) < 5:
             return None
         
         # Parse the JSON part (last column)
-        json_str = parts[4]
-        work = json.loads(json_str)
+        work = orjson.loads(parts[4])
         
         # Ensure type and key are set
         if "type" not in work:
-            work["type"] = parts[0]
+            work["type"] = parts[0].decode("utf-8")
         if "key" not in work:
-            work["key"] = parts[1]
+            work["key"] = parts[1].decode("utf-8")
         
         return work
-    except (json.JSONDecodeError, IndexError, ValueError) as e:
+    except (orjson.JSONDecodeError, IndexError, ValueError) as e:
         logger.debug(f"Failed to parse line: {e}")
         return None
 
 
+@contextmanager
+def open_dump(path: str) -> Iterator[BinaryIO]:
+    """
+    Open the gzipped dump for reading decompressed lines as bytes.
+    
+    Decompresses with pigz in a subprocess when it is installed, so
+    inflating runs on another core instead of in the parsing thread;
+    otherwise falls back to the gzip module.
+    """
+    pigz = shutil.which("pigz")
+    if not pigz:
+        with gzip.open(path, "rb") as f:
+            yield f
+        return
+    
+    proc = subprocess.Popen([pigz, "-dc", path], stdout=subprocess.PIPE, bufsize=1 << 20)
+    read_to_end = False
+    try:
+        yield proc.stdout
+        # Unread output means the caller stopped early (e.g. MAX_RECORDS)
+        read_to_end = not proc.stdout.read(1)
+    finally:
+        # Only an abandoned read is cut short; after EOF pigz is left to
+        # exit on its own so its real status is reported
+        if not read_to_end:
+            proc.terminate()
+        proc.stdout.close()
+        returncode = proc.wait()
+    
+    # A corrupt or truncated dump ends the output early; don't treat it as done
+    if read_to_end and returncode != 0:
+        raise RuntimeError(f"pigz exited with status {returncode} while reading {path}")
+
+
 def prepare_embedding_text(work: Dict) -> str:
     """Combine fields for embedding context."""
     title = work.get("title", "")
@@ -147,8 +212,238 @@ def prepare_embedding_text(work: Dict) -> str:
     return full_text
 
 
+def _detect_device() -> str:
+    """Pick the fastest available torch device: CUDA, then Apple MPS, then CPU."""
+    import torch
+    
+    if torch.cuda.is_available():
+        return "cuda"
+    if torch.backends.mps.is_available():
+        return "mps"
+    return "cpu"
+
+
+def load_embedding_model():
+    """
+    Load the embedding model for EMBEDDING_BACKEND.
+    
+    The onnx backend uses the same OnnxEmbeddingModel as the API (with
+    optional dynamic int8 quantization), which is typically several times
+    faster than PyTorch on CPU-only machines.
+    
+    Returns:
+        Tuple of (model, description for logging)
+    """
+    if EMBEDDING_BACKEND == "onnx":
+        from api.embedding import OnnxEmbeddingModel
+        
+        model = OnnxEmbeddingModel(MODEL_NAME, quantize=EMBEDDING_ONNX_QUANTIZE)
+        return model, "onnx, int8" if EMBEDDING_ONNX_QUANTIZE else "onnx"
+    
+    device = _detect_device()
+    return SentenceTransformer(MODEL_NAME, device=device), f"torch, {device}"
+
+
+def encode_batch(model, texts: List[str]):
+    """
+    Generate normalized embeddings for a batch of texts.
+    
+    Unit-length embeddings make cosine similarity equal to the inner
+    product, matching how the API encodes queries. Identical texts (common
+    among works sharing a title and subject list) are encoded once and
+    their embedding is copied to every position.
+    
+    Returns:
+        float32 array with one embedding row per input text
+    """
+    unique_index: Dict[str, int] = {}
+    positions = [unique_index.setdefault(text, len(unique_index)) for text in texts]
+    
+    embeddings = model.encode(
+        list(unique_index),
+        show_progress_bar=False,
+        batch_size=EMBEDDING_BATCH_SIZE,
+        convert_to_numpy=True,
+        normalize_embeddings=True
+    )
+    if len(unique_index) == len(texts):
+        return embeddings
+    return embeddings[positions]
+
+
+# Columns loaded per book, in COPY order
+BOOK_COLUMNS = "ol_key, title, authors, first_publish_year, subjects, search_content, embedding"
+BOOK_COLUMN_TYPES = ["text", "text", "text[]", "int4", "text[]", "text", "halfvec"]
+STAGING_TABLE = "books_staging"
+
+
+def create_staging_table(cur) -> None:
+    """
+    Create the session-local staging table batches are COPYed into.
+    
+    COPY can't skip conflicting rows, so each batch lands here first and
+    is moved into books with a single INSERT ... SELECT. Rows are dropped
+    automatically when the batch's transaction commits.
+    """
+    cur.execute(
+        f"""CREATE TEMP TABLE IF NOT EXISTS {STAGING_TABLE} (
+               ol_key TEXT,
+               title TEXT,
+               authors TEXT[],
+               first_publish_year INT,
+               subjects TEXT[],
+               search_content TEXT,
+               embedding halfvec
+           ) ON COMMIT DELETE ROWS"""
+    )
+
+
+def books_table_is_empty(cur) -> bool:
+    """Check whether the books table has no rows (i.e. this is a fresh load)."""
+    cur.execute("SELECT NOT EXISTS (SELECT 1 FROM books);")
+    return cur.fetchone()[0]
+
+
+def insert_batch(conn, batch_records: List[Dict], embeddings, skip_conflicts: bool = True) -> None:
+    """
+    Insert a batch of books with their embeddings.
+    
+    Rows are streamed with binary COPY (embeddings in pgvector's binary
+    format, no per-row statements or text parsing) into the staging
+    table, then inserted into books in one statement.
+    
+    Args:
+        conn: Database connection with pgvector types registered
+        batch_records: Book records from the dump
+        embeddings: float32 array with one embedding row per record
+        skip_conflicts: Skip books whose ol_key already exists. Only safe
+            to disable when the table started empty and keys are unique
+            within the run, since a conflict then fails the whole batch.
+    """
+    on_conflict = "ON CONFLICT (ol_key) DO NOTHING" if skip_conflicts else ""
+    with conn.transaction():
+        with conn.cursor() as cur:
+            with cur.copy(f"COPY {STAGING_TABLE} ({BOOK_COLUMNS}) FROM STDIN WITH (FORMAT BINARY)") as copy:
+                copy.set_types(BOOK_COLUMN_TYPES)
+                for r, embedding in zip(batch_records, embeddings):
+                    copy.write_row((
+                        r["ol_key"],
+                        r["title"],
+                        r["authors"],
+                        r["year"],
+                        r["subjects"],
+                        r["search_content"],
+                        HalfVector(embedding),
+                    ))
+            
+            cur.execute(
+                f"""INSERT INTO books ({BOOK_COLUMNS})
+                   SELECT {BOOK_COLUMNS} FROM {STAGING_TABLE}
+                   {on_conflict}"""
+            )
+
+
+def run_encoder(model, batches: queue.Queue, encoded: queue.Queue, stats: Dict[str, int]) -> None:
+    """
+    Pipeline stage 2: encode parsed batches and pass them to the writer.
+    
+    Runs in its own thread so the model (which releases the GIL while
+    computing) works on one batch while the next is parsed and the
+    previous one is inserted. A None batch marks the end of input; run
+    under run_stage(), which forwards it to the writer.
+    """
+    while True:
+        batch = batches.get()
+        if batch is None:
+            return
+        
+        batch_records, batch_texts = batch
+        try:
+            # Generate embeddings with smaller batch size for memory efficiency
+            embeddings = encode_batch(model, batch_texts)
+        except Exception as e:
+            logger.error(f"❌ Error encoding batch: {e}")
+            stats["encode_errors"] += len(batch_records)
+            continue
+        
+        encoded.put((batch_records, embeddings))
+
+
+def run_writer(
+    conn,
+    encoded: queue.Queue,
+    stats: Dict[str, int],
+    pbar: tqdm,
+    skip_conflicts: bool = True
+) -> None:
+    """
+    Pipeline stage 3: insert encoded batches until the end-of-input marker.
+    
+    Owns the database connection once the pipeline is running.
+    """
+    while True:
+        batch = encoded.get()
+        if batch is None:
+            return
+        
+        batch_records, embeddings = batch
+        try:
+            insert_batch(conn, batch_records, embeddings, skip_conflicts)
+        except Exception as e:
+            logger.error(f"❌ Error inserting batch: {e}")
+            stats["insert_errors"] += len(batch_records)
+            continue
+        
+        previous = stats["inserted"]
+        stats["inserted"] += len(batch_records)
+        pbar.set_postfix({"inserted": stats["inserted"]})
+        
+        # Log progress every 10k records
+        if stats["inserted"] // 10000 > previous // 10000:
+            logger.info(f"📊 Progress: {stats['inserted']:,} records inserted")
+
+
+def run_stage(
+    stage: Callable[..., None],
+    upstream: queue.Queue,
+    downstream: Optional[queue.Queue],
+    failed: threading.Event,
+    errors: List[BaseException],
+    *args
+) -> None:
+    """
+    Run a pipeline stage in a way that can't deadlock its neighbours.
+    
+    The end-of-input marker is always passed downstream, even if the
+    stage crashes, so the next stage finishes. A crashed stage records
+    its exception, sets failed (the parser stops producing), and keeps
+    draining its input so the stage feeding it never blocks on a full
+    queue.
+    """
+    try:
+        stage(*args)
+    except BaseException as e:
+        logger.error(f"❌ Pipeline stage '{threading.current_thread().name}' failed: {e}")
+        errors.append(e)
+        failed.set()
+        while upstream.get() is not None:
+            pass
+    finally:
+        if downstream is not None:
+            downstream.put(None)
+
+
 def main():
-    """Main ETL pipeline."""
+    """
+    Main ETL pipeline.
+    
+    Parsing, encoding and inserting run as three overlapping stages
+    connected by bounded queues: this thread parses and batches the dump,
+    an encoder thread generates embeddings, and a writer thread COPYs
+    them into the database. The queues (PIPELINE_DEPTH batches each)
+    apply back-pressure, so a slow stage throttles the others instead of
+    batches piling up in memory.
+    """
     # Validate configuration
     if not DATABASE_URL:
         logger.error("❌ DATABASE_URL environment variable is required")
@@ -161,10 +456,11 @@ def main():
     
     logger.info("🚀 Starting ETL Pipeline")
     logger.info(f"   Dump file: {DUMP_FILE}")
+    logger.info(f"   Decompression: {'pigz' if shutil.which('pigz') else 'gzip (install pigz for faster reads)'}")
     logger.info(f"   Model: {MODEL_NAME}")
-    logger.info(f"   Batch size: {BATCH_SIZE} (optimized for low resource usage)")
+    logger.info(f"   Batch size: {BATCH_SIZE}")
     logger.info(f"   Embedding batch size: {EMBEDDING_BATCH_SIZE} (memory-friendly)")
-    logger.info(f"   Batch delay: {BATCH_DELAY}s (CPU throttling)")
+    logger.info(f"   Pipeline depth: {PIPELINE_DEPTH} batches per stage")
     logger.info(f"   Min subjects: {MIN_SUBJECTS}")
     if MAX_RECORDS > 0:
         logger.info(f"   Max records (test mode): {MAX_RECORDS:,}")
@@ -174,8 +470,8 @@ def main():
     # Load embedding model
     logger.info("📦 Loading embedding model...")
     try:
-        model = SentenceTransformer(MODEL_NAME)
-        logger.info("✅ Model loaded successfully")
+        model, backend = load_embedding_model()
+        logger.info(f"✅ Model loaded successfully ({backend})")
     except Exception as e:
         logger.error(f"❌ Failed to load model: {e}")
         sys.exit(1)
@@ -184,8 +480,15 @@ def main():
     logger.info("🔌 Connecting to database...")
     try:
         conn = psycopg.connect(DATABASE_URL, autocommit=True)
+        register_vector(conn)
         cur = conn.cursor()
+        create_staging_table(cur)
+        # Loading into an empty table, skipping repeated keys below makes
+        # every row new, so the per-row ON CONFLICT probe can be dropped
+        skip_conflicts = not books_table_is_empty(cur)
         logger.info("✅ Database connected")
+        if not skip_conflicts:
+            logger.info("   Empty books table: inserting without conflict checks")
     except Exception as e:
         logger.error(f"❌ Database connection failed: {e}")
         sys.exit(1)
@@ -193,21 +496,47 @@ def main():
     # Process dump file
     logger.info("📖 Processing dump file...")
     records_processed = 0
-    records_inserted = 0
+    records_batched = 0
     records_skipped = 0
-    errors = 0
+    records_duplicate = 0
+    # Open Library keys already batched in this run
+    seen_keys = set()
+    
+    # Use tqdm for progress tracking (estimate file size)
+    file_size = Path(DUMP_FILE).stat().st_size
+    pbar = tqdm(total=file_size, unit="B", unit_scale=True, desc="Processing")
+    
+    # Start the encoder and writer stages
+    batches: queue.Queue = queue.Queue(maxsize=PIPELINE_DEPTH)
+    encoded: queue.Queue = queue.Queue(maxsize=PIPELINE_DEPTH)
+    stats = {"inserted": 0, "encode_errors": 0, "insert_errors": 0}
+    # Set (and the exception recorded) if a stage thread crashes
+    failed = threading.Event()
+    stage_errors: List[BaseException] = []
+    workers = [
+        threading.Thread(
+            target=run_stage,
+            args=(run_encoder, batches, encoded, failed, stage_errors, model, batches, encoded, stats),
+            name="encoder",
+            daemon=True
+        ),
+        threading.Thread(
+            target=run_stage,
+            args=(run_writer, encoded, None, failed, stage_errors, conn, encoded, stats, pbar, skip_conflicts),
+            name="writer",
+            daemon=True
+        ),
+    ]
+    for worker in workers:
+        worker.start()
     
     try:
-        with gzip.open(DUMP_FILE, "rt", encoding="utf-8") as f:
-            # Use tqdm for progress tracking (estimate file size)
-            file_size = Path(DUMP_FILE).stat().st_size
-            pbar = tqdm(total=file_size, unit="B", unit_scale=True, desc="Processing")
-            
+        with open_dump(DUMP_FILE) as f:
             batch_records = []
             batch_texts = []
             
             for line in f:
-                pbar.update(len(line.encode("utf-8")))
+                pbar.update(len(line))
                 
                 # Parse line
                 work = parse_dump_line(line)
@@ -216,155 +545,83 @@ def main():
                 
                 records_processed += 1
                 
-                # Check if we've reached the max records limit (for testing)
-                if MAX_RECORDS > 0 and records_inserted >= MAX_RECORDS:
-                    logger.info(f"✅ Reached max records limit ({MAX_RECORDS:,}). Stopping processing.")
-                    break
-                
                 # Filter for quality
                 if not is_quality_record(work):
                     records_skipped += 1
                     continue
                 
-                # Extract data
+                # Keep only the first record for each key; later ones would
+                # be encoded for nothing and then conflict on insert
                 ol_key = work.get("key", "")
-                title = work.get("title", "")
-                authors = extract_authors(work)
-                subjects = work.get("subjects", [])
-                year = extract_publish_year(work)
+                if ol_key in seen_keys:
+                    records_duplicate += 1
+                    continue
+                seen_keys.add(ol_key)
+                
+                # Extract data
                 search_content = prepare_embedding_text(work)
+                if len(search_content) < MIN_TEXT_LENGTH:
+                    records_skipped += 1
+                    continue
                 
                 # Add to batch
                 batch_records.append({
                     "ol_key": ol_key,
-                    "title": title,
-                    "authors": authors,
-                    "subjects": subjects,
-                    "year": year,
+                    "title": work.get("title", ""),
+                    "authors": extract_authors(work),
+                    "subjects": work.get("subjects", []),
+                    "year": extract_publish_year(work),
                     "search_content": search_content,
                 })
                 batch_texts.append(search_content)
+                records_batched += 1
                 
-                # Process batch when full
+                # Check if we've reached the max records limit (for testing)
+                if MAX_RECORDS > 0 and records_batched >= MAX_RECORDS:
+                    logger.info(f"✅ Reached max records limit ({MAX_RECORDS:,}). Stopping processing.")
+                    break
+                
+                # Hand the batch to the encoder when full (blocks while
+                # the downstream stages are PIPELINE_DEPTH batches behind)
                 if len(batch_records) >= BATCH_SIZE:
-                    try:
-                        # Generate embeddings with smaller batch size for memory efficiency
-                        embeddings = model.encode(
-                            batch_texts, 
-                            show_progress_bar=False,
-                            batch_size=EMBEDDING_BATCH_SIZE,
-                            convert_to_numpy=True
-                        )
-                        
-                        # Prepare data for insertion
-                        data_tuples = [
-                            (
-                                r["ol_key"],
-                                r["title"],
-                                r["authors"],
-                                r["year"],
-                                r["subjects"],
-                                r["search_content"],
-                                embedding.tolist(),
-                            )
-                            for r, embedding in zip(batch_records, embeddings)
-                        ]
-                        
-                        # Batch insert
-                        cur.executemany(
-                            """INSERT INTO books 
-                               (ol_key, title, authors, first_publish_year, subjects, search_content, embedding)
-                               VALUES (%s, %s, %s, %s, %s, %s, %s::vector)
-                               ON CONFLICT (ol_key) DO NOTHING""",
-                            data_tuples,
-                        )
-                        
-                        records_inserted += len(batch_records)
-                        pbar.set_postfix({
-                            "processed": records_processed,
-                            "inserted": records_inserted,
-                            "skipped": records_skipped,
-                        })
-                        
-                        # Log progress every 10k records
-                        if records_inserted % 10000 == 0:
-                            logger.info(f"📊 Progress: {records_inserted:,} records inserted, {records_processed:,} processed, {records_skipped:,} skipped")
-                        
-                        # Check limit after batch insert
-                        if MAX_RECORDS > 0 and records_inserted >= MAX_RECORDS:
-                            logger.info(f"✅ Reached max records limit ({MAX_RECORDS:,}). Stopping processing.")
-                            break
-                        
-                    except Exception as e:
-                        logger.error(f"❌ Error processing batch: {e}")
-                        errors += len(batch_records)
-                    
-                    # Reset batch
+                    if failed.is_set():
+                        break
+                    batches.put((batch_records, batch_texts))
                     batch_records = []
                     batch_texts = []
-                    
-                    # Gentle CPU throttling - small delay between batches
-                    if BATCH_DELAY > 0:
-                        time.sleep(BATCH_DELAY)
-                    
-                    # Check limit before continuing
-                    if MAX_RECORDS > 0 and records_inserted >= MAX_RECORDS:
-                        break
             
             # Process remaining records
-            if batch_records:
-                try:
-                    embeddings = model.encode(
-                        batch_texts, 
-                        show_progress_bar=False,
-                        batch_size=EMBEDDING_BATCH_SIZE,
-                        convert_to_numpy=True
-                    )
-                    data_tuples = [
-                        (
-                            r["ol_key"],
-                            r["title"],
-                            r["authors"],
-                            r["year"],
-                            r["subjects"],
-                            r["search_content"],
-                            embedding.tolist(),
-                        )
-                        for r, embedding in zip(batch_records, embeddings)
-                    ]
-                    cur.executemany(
-                        """INSERT INTO books 
-                           (ol_key, title, authors, first_publish_year, subjects, search_content, embedding)
-                           VALUES (%s, %s, %s, %s, %s, %s, %s::vector)
-                           ON CONFLICT (ol_key) DO NOTHING""",
-                        data_tuples,
-                    )
-                    records_inserted += len(batch_records)
-                except Exception as e:
-                    logger.error(f"❌ Error processing final batch: {e}")
-                    errors += len(batch_records)
-            
-            pbar.close()
+            if batch_records and not failed.is_set():
+                batches.put((batch_records, batch_texts))
     
     except Exception as e:
         logger.error(f"❌ Fatal error processing dump: {e}")
         sys.exit(1)
     finally:
+        # Let the encoder and writer drain what was queued, then stop
+        batches.put(None)
+        for worker in workers:
+            worker.join()
+        pbar.close()
         conn.close()
     
+    if stage_errors:
+        logger.error("❌ ETL Pipeline aborted: a pipeline stage failed")
+        raise stage_errors[0]
+    
     # Summary
     logger.info("✅ ETL Pipeline completed!")
     logger.info(f"   Records processed: {records_processed:,}")
-    logger.info(f"   Records inserted: {records_inserted:,}")
+    logger.info(f"   Records inserted: {stats['inserted']:,}")
     logger.info(f"   Records skipped: {records_skipped:,}")
-    logger.info(f"   Errors: {errors:,}")
+    logger.info(f"   Duplicate keys skipped: {records_duplicate:,}")
+    logger.info(f"   Errors: {stats['encode_errors'] + stats['insert_errors']:,}")
     
     # Note about index creation
     logger.info("")
-    logger.info("📝 Note: Create the IVFFlat index after data load:")
-    logger.info("   CREATE INDEX books_embedding_idx ON books USING ivfflat (embedding vector_cosine_ops) WITH (lists = 1000);")
+    logger.info("📝 Note: Create the HNSW index after data load (or run scripts/optimize_indexes.py):")
+    logger.info("   CREATE INDEX books_embedding_idx ON books USING hnsw (embedding halfvec_ip_ops) WITH (m = 16, ef_construction = 64);")
 
 
 if __name__ == "__main__":
     main()
-
@@ -17,6 +17,40 @@ if not DATABASE_URL:
     sys.exit(1)
 
 
+def migrate_embedding_to_halfvec(cur) -> bool:
+    """
+    Convert a books.embedding column created as vector(384) to halfvec(384).
+    
+    Databases initialized before the halfvec switch keep their FP32 column,
+    since CREATE TABLE IF NOT EXISTS leaves existing tables alone. The cast
+    halves heap and index size without re-embedding. A vector_cosine_ops
+    index can't be kept across the type change, so it is dropped and must
+    be rebuilt afterwards with scripts/optimize_indexes.py.
+    
+    Returns:
+        True if the column was migrated
+    """
+    cur.execute(
+        """
+        SELECT format_type(atttypid, atttypmod)
+        FROM pg_attribute
+        WHERE attrelid = to_regclass('books')
+        AND attname = 'embedding'
+        AND NOT attisdropped;
+        """
+    )
+    row = cur.fetchone()
+    if not row or not row[0].startswith("vector"):
+        return False
+    
+    print(f"Migrating books.embedding from {row[0]} to halfvec(384)...")
+    print("⏳ This rewrites the table and locks it for the duration...")
+    cur.execute("DROP INDEX IF EXISTS books_embedding_idx;")
+    cur.execute("ALTER TABLE books ALTER COLUMN embedding TYPE halfvec(384) USING embedding::halfvec(384);")
+    print("✅ Embedding column migrated. Rebuild the vector index with scripts/optimize_indexes.py")
+    return True
+
+
 def init_database():
     """Initialize the database with schema and extensions."""
     try:
@@ -46,14 +80,16 @@ def init_database():
                             first_publish_year INT,
                             subjects TEXT[],
                             search_content TEXT,
-                            embedding vector(384)
+                            embedding halfvec(384)
                         );
                     """)
                     
                     # Create basic indexes
                     cur.execute("CREATE INDEX IF NOT EXISTS idx_books_ol_key ON books(ol_key);")
-                    cur.execute("CREATE INDEX IF NOT EXISTS idx_books_title ON books(title);")
                     cur.execute("CREATE INDEX IF NOT EXISTS idx_books_year ON books(first_publish_year);")
+                    cur.execute("DROP INDEX IF EXISTS idx_books_title;")
+                
+                migrate_embedding_to_halfvec(cur)
                 
                 conn.commit()
                 print("✅ Database initialized successfully!")
@@ -13,19 +13,68 @@ CREATE TABLE IF NOT EXISTS books (
     first_publish_year INT,
     subjects TEXT[],                     -- Raw subject list for UI display
     search_content TEXT,                 -- Concatenated string for context
-    embedding vector(384)                -- Dimensions of 'all-MiniLM-L6-v2'
+    embedding halfvec(384)               -- Dimensions of 'all-MiniLM-L6-v2'
 );
 
 -- Create index for performance
--- Note: We'll create the IVFFlat index AFTER data load for speed
+-- Note: We'll create the HNSW index AFTER data load for speed
 -- This is a placeholder - the actual index will be created after ETL completes
--- CREATE INDEX books_embedding_idx ON books USING ivfflat (embedding vector_cosine_ops) WITH (lists = 1000);
+-- CREATE INDEX books_embedding_idx ON books USING hnsw (embedding halfvec_ip_ops) WITH (m = 16, ef_construction = 64);
 
 -- Create indexes for common queries
 CREATE INDEX IF NOT EXISTS idx_books_ol_key ON books(ol_key);
-CREATE INDEX IF NOT EXISTS idx_books_title ON books(title);
 CREATE INDEX IF NOT EXISTS idx_books_year ON books(first_publish_year);
 
+-- No title index: no query filters on exact titles, and each extra index
+-- adds a page update to every row the ETL loads
+DROP INDEX IF EXISTS idx_books_title;
+
+-- Notify the API when books change so it can invalidate cached responses.
+-- One notification per statement: updates and deletes touching only a few
+-- rows send their IDs comma-separated, anything larger (and every insert)
+-- sends an empty payload, which clears everything, so bulk changes don't
+-- flood the channel or overflow its 8000-byte payload limit.
+CREATE OR REPLACE FUNCTION notify_book_changes() RETURNS trigger AS $$
+DECLARE
+    changed_count bigint;
+    changed_ids text;
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        PERFORM pg_notify('book_changes', '');
+        RETURN NULL;
+    END IF;
+    
+    SELECT count(*) INTO changed_count FROM old_rows;
+    IF changed_count = 0 THEN
+        RETURN NULL;
+    ELSIF changed_count <= 100 THEN
+        SELECT string_agg(id::text, ',') INTO changed_ids FROM old_rows;
+        PERFORM pg_notify('book_changes', changed_ids);
+    ELSE
+        PERFORM pg_notify('book_changes', '');
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Transition tables need one trigger per event, and a row-level trigger
+-- can't be replaced in place by a statement-level one
+DROP TRIGGER IF EXISTS books_changed ON books;
+
+CREATE OR REPLACE TRIGGER books_updated
+    AFTER UPDATE ON books
+    REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION notify_book_changes();
+
+CREATE OR REPLACE TRIGGER books_deleted
+    AFTER DELETE ON books
+    REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION notify_book_changes();
+
+CREATE OR REPLACE TRIGGER books_inserted
+    AFTER INSERT ON books
+    FOR EACH STATEMENT EXECUTE FUNCTION notify_book_changes();
+
 -- Grant permissions (if needed for additional users)
 -- GRANT ALL PRIVILEGES ON TABLE books TO whattoread;
 -- GRANT USAGE, SELECT ON SEQUENCE books_id_seq TO whattoread;
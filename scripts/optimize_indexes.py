@@ -3,12 +3,12 @@
 Optimize database indexes for performance.
 
 This script:
-1. Calculates optimal IVFFlat index parameters based on table size
-2. Creates or recreates the vector index with optimal settings
-3. Analyzes the table for query planner optimization
-4. Provides index usage statistics
+1. Calculates HNSW index parameters (m, ef_construction) based on table size
+2. Creates or recreates the vector index with those settings
+3. Sets parallel_workers on the table for parallel full scans
+4. Analyzes the table for query planner optimization
+5. Provides index usage statistics
 """
-import math
 import os
 import sys
 from pathlib import Path
@@ -20,6 +20,19 @@ sys.path.insert(0, str(Path(__file__).parent.parent))
 
 from api.config import settings
 
+# Session settings for the index build: HNSW builds far faster when the
+# graph fits in maintenance_work_mem, and can use parallel workers
+MAINTENANCE_WORK_MEM = os.getenv("INDEX_MAINTENANCE_WORK_MEM", "2GB")
+MAX_PARALLEL_MAINTENANCE_WORKERS = int(os.getenv("INDEX_MAX_PARALLEL_WORKERS", "7"))
+
+# Embeddings are unit-length, so the API searches by inner product (<#>);
+# the index must use the matching operator class to serve those queries
+VECTOR_OPCLASS = "halfvec_ip_ops"
+
+# Planner hint for parallel sequential scans over books (e.g. exact
+# COUNT(*) and reporting queries); 0 keeps the size-based default
+TABLE_PARALLEL_WORKERS = int(os.getenv("TABLE_PARALLEL_WORKERS", "8"))
+
 def get_table_size(conn) -> int:
     """Get the number of records in the books table."""
     with conn.cursor() as cur:
@@ -28,25 +41,54 @@ def get_table_size(conn) -> int:
         return result[0] if result else 0
 
 
-def calculate_optimal_lists(table_size: int) -> int:
+def calculate_hnsw_params(table_size: int) -> dict:
     """
-    Calculate optimal lists parameter for IVFFlat index.
+    Calculate HNSW index parameters for the table size.
     
-    Recommended formula: lists = sqrt(total_rows) / 1000
-    But keep within reasonable bounds (100 to 10000)
-    """
-    if table_size == 0:
-        return 100  # Default for empty table
+    Larger tables get more links per node (m) and a wider build-time
+    candidate list (ef_construction) to keep recall up, at the cost of
+    build time and index size. The query-time ef_search isn't sized here:
+    a scan returns at most ef_search rows, so it is governed by the API's
+    result limit (see check_ef_search).
     
-    # Calculate based on formula
-    optimal_lists = int(math.sqrt(table_size) / 1000)
+    Returns:
+        Dictionary with m and ef_construction
+    """
+    if table_size < 100_000:
+        m, ef_construction = 16, 64
+    elif table_size < 1_000_000:
+        m, ef_construction = 24, 100
+    else:
+        m, ef_construction = 32, 128
     
-    # Keep within reasonable bounds
-    # Minimum 100 for small tables
-    # Maximum 10000 for very large tables (pgvector recommendation)
-    optimal_lists = max(100, min(10000, optimal_lists))
+    return {"m": m, "ef_construction": ef_construction}
+
+
+def check_ef_search():
+    """Report the API's hnsw.ef_search and warn if it would truncate results."""
+    print(f"  Query-time HNSW_EF_SEARCH (applied per API connection): {settings.hnsw_ef_search}")
+    if settings.hnsw_ef_search < settings.max_recommendations:
+        print(
+            f"  ⚠️  HNSW_EF_SEARCH is below max_recommendations ({settings.max_recommendations}); "
+            f"searches will return at most {settings.hnsw_ef_search} books"
+        )
+
+
+def set_table_parallel_workers(conn, workers: int):
+    """
+    Set the planner's parallel worker count for scans of the books table.
     
-    return optimal_lists
+    Args:
+        conn: Database connection
+        workers: Parallel workers for full scans (0 keeps the default)
+    """
+    if workers <= 0:
+        return
+    print(f"\n⚙️  Setting parallel_workers = {workers} on books...")
+    with conn.cursor() as cur:
+        cur.execute(f"ALTER TABLE books SET (parallel_workers = {workers});")
+        conn.commit()
+    print("  ✅ Table storage parameter set")
 
 
 def index_exists(conn, index_name: str) -> bool:
@@ -84,13 +126,14 @@ def get_index_info(conn, index_name: str):
         return cur.fetchone()
 
 
-def create_vector_index(conn, lists: int, drop_existing: bool = False):
+def create_vector_index(conn, m: int, ef_construction: int, drop_existing: bool = False):
     """
-    Create or recreate the IVFFlat vector index.
+    Create or recreate the HNSW vector index.
     
     Args:
         conn: Database connection
-        lists: Number of lists for IVFFlat index
+        m: Max connections per node in the HNSW graph
+        ef_construction: Candidate list size while building the graph
         drop_existing: Whether to drop existing index first
     """
     index_name = "books_embedding_idx"
@@ -102,16 +145,20 @@ def create_vector_index(conn, lists: int, drop_existing: bool = False):
             conn.commit()
             print(f"  ✅ Index dropped")
         
-        print(f"  Creating IVFFlat index with lists={lists}...")
+        print(f"  Creating HNSW index with m={m}, ef_construction={ef_construction}...")
+        print(f"  Using maintenance_work_mem={MAINTENANCE_WORK_MEM}, "
+              f"max_parallel_maintenance_workers={MAX_PARALLEL_MAINTENANCE_WORKERS}")
         print(f"  ⏳ This may take several minutes for large tables...")
         
         try:
+            cur.execute(f"SET maintenance_work_mem = '{MAINTENANCE_WORK_MEM}';")
+            cur.execute(f"SET max_parallel_maintenance_workers = {MAX_PARALLEL_MAINTENANCE_WORKERS};")
             cur.execute(
                 f"""
                 CREATE INDEX {index_name}
                 ON books 
-                USING ivfflat (embedding vector_cosine_ops) 
-                WITH (lists = {lists});
+                USING hnsw (embedding {VECTOR_OPCLASS}) 
+                WITH (m = {m}, ef_construction = {ef_construction});
                 """
             )
             conn.commit()
@@ -194,11 +241,11 @@ def main():
             print("  ⚠️  Table is empty. Skipping index optimization.")
             return
         
-        # Calculate optimal lists parameter
-        optimal_lists = calculate_optimal_lists(table_size)
+        # Calculate HNSW parameters
+        params = calculate_hnsw_params(table_size)
         print(f"\n🎯 Optimal index configuration:")
-        print(f"  Recommended lists parameter: {optimal_lists}")
-        print(f"  (Formula: sqrt({table_size:,}) / 1000 ≈ {int(math.sqrt(table_size) / 1000)})")
+        print(f"  m = {params['m']}, ef_construction = {params['ef_construction']}")
+        check_ef_search()
         
         # Check if index exists
         index_name = "books_embedding_idx"
@@ -210,16 +257,21 @@ def main():
             if index_info:
                 print(f"  Current definition: {index_info[1]}")
             
+            if index_info and VECTOR_OPCLASS not in index_info[1]:
+                # e.g. an index built for cosine distance; search queries can't use it
+                print(f"  ⚠️  Index doesn't use {VECTOR_OPCLASS}, so the API's search can't use it")
+                create_vector_index(conn, params["m"], params["ef_construction"], drop_existing=True)
             # Check if we should recreate it
-            response = input("\n  Recreate index with optimal parameters? (y/N): ").strip().lower()
-            if response == 'y':
-                create_vector_index(conn, optimal_lists, drop_existing=True)
+            elif input("\n  Recreate index with optimal parameters? (y/N): ").strip().lower() == 'y':
+                create_vector_index(conn, params["m"], params["ef_construction"], drop_existing=True)
             else:
                 print("  Skipping index recreation")
         else:
             # Create new index
             print(f"\n🔨 Creating vector index...")
-            create_vector_index(conn, optimal_lists, drop_existing=False)
+            create_vector_index(conn, params["m"], params["ef_construction"], drop_existing=False)
+        
+        set_table_parallel_workers(conn, TABLE_PARALLEL_WORKERS)
         
         # Analyze table
         analyze_table(conn)
@@ -231,7 +283,7 @@ def main():
         print("\n💡 Tips:")
         print("  - Monitor query performance with EXPLAIN ANALYZE")
         print("  - Re-optimize if table size changes significantly")
-        print("  - Higher 'lists' = faster queries but slower index creation")
+        print("  - Higher HNSW_EF_SEARCH = better recall but slower queries")
         
     except Exception as e:
         print(f"\n❌ Error: {e}")